@@ -2,11 +2,21 @@ import numpy as np
 import pandas as pd
 import sqlalchemy
 import traceback
+import re
+import json
+import os
+import pyarrow as pa
+import pyarrow.feather as feather
 from db.hvacDBMapping import *
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-from sqlalchemy import and_
-from copy import copy
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select
+from sqlalchemy.orm import class_mapper
+from concurrent.futures import ThreadPoolExecutor
+
+
+#Cleaning flags of the columns of every reading class, see columnMetadata
+_columnMetadata = dict()
 
 def getDBSession(db, host, user, password):
 	"""Attempt to connect to the database an get a session to it"""
@@ -63,110 +73,347 @@ def getComponentReadingClassByType(componentType):
 	return componentClass
 
 
-def loadData(session, startTimestamp, endTimestamp, componentTypes = []):
-	"""Return a list of dataframes with the data for each of the components in componentTypes in the indicated period"""
+def componentColumnArray(values, columnType):
+	"""Turn the list of values of a column into a numpy array with the dtype pandas would have inferred for it"""
 
-	#THIS MUST BE PARALLELIZED ON ORDER TO ACHIEVE ITS MAXIMUM PERFORMANCE
+	hasNulls = any(value is None for value in values)
 
-	#session = getDBSession()
-	session = session
-	readings = dict()
-	dataFrames = dict()
+	if isinstance(columnType, sqlalchemy.Float):
+		return np.array(values, dtype=np.float64)
+	elif isinstance(columnType, sqlalchemy.Boolean):
+		return np.array(values, dtype=object if hasNulls else bool)
+	elif isinstance(columnType, sqlalchemy.Integer):
+		return np.array(values, dtype=np.float64 if hasNulls else np.int64)
+	elif isinstance(columnType, sqlalchemy.DateTime):
+		return np.array(values, dtype='datetime64[ns]')
+	else:
+		return np.array(values, dtype=object)
+
+
+def readComponentDataFrame(engine, componentReadingClass, startTimestamp, endTimestamp, chunkSize=10000, componentIds=None):
+	"""Read the readings of componentReadingClass in [startTimestamp, endTimestamp) with a Core select and return them as a dataframe.
+
+	The rows are streamed from a server side cursor chunkSize at a time and go straight into column arrays, no ORM
+	objects are built. The columns are named after the attributes of the class (_timestamp, _thermafuserId...) as
+	the ORM based loader did. componentIds limits the query to those components."""
+
+	columnProperties = class_mapper(componentReadingClass).column_attrs
+	columnKeys = [columnProperty.key for columnProperty in columnProperties]
+	columnTypes = [columnProperty.columns[0].type for columnProperty in columnProperties]
+
+	query = select(*[columnProperty.columns[0] for columnProperty in columnProperties])\
+		.where(and_(componentReadingClass._timestamp >= startTimestamp, componentReadingClass._timestamp < endTimestamp))
+
+	if componentIds is not None:
+		query = query.where(getattr(componentReadingClass, componentIdKey(componentReadingClass)).in_(list(componentIds)))
+
+	columns = [list() for key in columnKeys]
 
-	count = 0
+	with engine.connect() as connection:
+		result = connection.execution_options(yield_per=chunkSize).execute(query)
+
+		for rows in result.partitions():
+			for column, values in zip(columns, zip(*rows)):
+				column.extend(values)
+
+	if not columns or not columns[0]:
+		return None
+
+	return pd.DataFrame({key:componentColumnArray(values, columnType) for key, values, columnType in zip(columnKeys, columns, columnTypes)}, copy=False)
+
+
+def loadData(session, startTimestamp, endTimestamp, componentTypes = [], maxWorkers=4):
+	"""Return a list of dataframes with the data for each of the components in componentTypes in the indicated period.
+
+	Each component type is read by readComponentDataFrame in its own thread (up to maxWorkers at once), all of
+	them use the connection pool of the engine the session is bound to."""
+
+	engine = session.get_bind()
 
 	componentsReadingClass = [getComponentReadingClassByType(component) for component in componentTypes]
 
 	#This goes to the log
 	print(startTimestamp, endTimestamp, componentsReadingClass)
 
-	#Create the dataframes for each component
-	for componentReadingClass in componentsReadingClass:
-		readings = \
-		session.query(componentReadingClass).filter(and_(componentReadingClass._timestamp >= startTimestamp, componentReadingClass._timestamp < endTimestamp)).all()
+	with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(componentsReadingClass)))) as executor:
+		frames = list(executor.map(lambda componentReadingClass: readComponentDataFrame(engine, componentReadingClass, startTimestamp, endTimestamp), componentsReadingClass))
+
+	#Component types without readings in the period are left out, as before
+	dataFrames = {componentType:frame for componentType, frame in zip(componentTypes, frames) if frame is not None}
+
+	return dataFrames
+
+
+def componentIdKey(componentReadingClass):
+	"""Return the attribute key of the component id column of a reading class (_thermafuserId, _AHUNumber...)"""
+
+	return [columnProperty.key for columnProperty in class_mapper(componentReadingClass).column_attrs
+		if columnProperty.columns[0].primary_key and columnProperty.key != '_timestamp'][0]
+
+
+def readCacheManifest(classDir):
+	"""Return the days (YYYY-MM-DD) completely stored in the cache directory of a reading class: 'days' has the
+	days cached for every component and 'components' the days cached for some components only, by component id"""
+
+	try:
+		with open(os.path.join(classDir, 'manifest.json')) as manifestFile:
+			manifest = json.load(manifestFile)
+	except FileNotFoundError:
+		manifest = {}
+
+	return {'days': set(manifest.get('days', [])),
+		'components': {componentId:set(days) for componentId, days in manifest.get('components', {}).items()}}
+
+
+def cachedDays(manifest, componentIds=None):
+	"""Return the days of the manifest that are cached for all of componentIds (for every component if None)"""
+
+	if componentIds is None:
+		return manifest['days']
+
+	componentDays = [manifest['days'] | manifest['components'].get(str(componentId), set()) for componentId in componentIds]
+
+	return set.intersection(*componentDays) if componentDays != [] else manifest['days']
+
+
+def writeCacheManifest(classDir, manifest):
+
+	manifestPath = os.path.join(classDir, 'manifest.json')
+
+	with open(manifestPath + '.tmp', 'w') as manifestFile:
+		json.dump({'days': sorted(manifest['days']),
+			'components': {componentId:sorted(days) for componentId, days in manifest['components'].items()}}, manifestFile)
+
+	#Replace the manifest atomically so a crash never leaves a day marked complete without its files
+	os.replace(manifestPath + '.tmp', manifestPath)
+
+
+def cacheMissingDays(session, componentReadingClass, days, classDir, manifest, componentIds=None):
+	"""Read the given days from the database and store them in the cache, partitioned by component id and day.
+
+	Consecutive days are read with a single query, of componentIds only if given. Only the days that are over are
+	added to manifest (for componentIds only if given), the current day is fetched again on every call. Return the
+	dataframes of the days that can not be cached yet."""
+
+	idKey = componentIdKey(componentReadingClass)
+	incompleteFrames = []
+	today = datetime.now().date()
 
-		if readings != []:
-			#build the dictionary object
-			dictionaryOfReadings = copy(readings[0]).__dict__
-			dictionaryOfReadings.pop('_sa_instance_state')
+	ranges = []
 
-			#This is performed fast, no need to change it
-			for key in dictionaryOfReadings:
-				dictionaryOfReadings[key] = list()
+	for day in sorted(days):
+		if ranges != [] and ranges[-1][1] == day:
+			ranges[-1][1] = day + timedelta(days=1)
+		else:
+			ranges.append([day, day + timedelta(days=1)])
 
-			keys = dictionaryOfReadings.keys()
-			
-			#Can we make this perform faster?
-			for reading in readings:
-				readingAsDict = reading.__dict__
-				readingAsDict.pop('_sa_instance_state')
+	for rangeStart, rangeEnd in ranges:
+		frame = readComponentDataFrame(session.get_bind(), componentReadingClass, datetime.combine(rangeStart, datetime.min.time()), datetime.combine(rangeEnd, datetime.min.time()),
+			componentIds=componentIds)
 
-				#Can we write a map function (functional programming) for this?
-				for key in keys:
-					dictionaryOfReadings[key].append(readingAsDict[key])
+		if frame is not None:
+			frameDays = frame['_timestamp'].dt.date
 
-			dataFrames[componentTypes[count]] =  pd.DataFrame.from_dict(dictionaryOfReadings)
+			for (componentId, day), dayFrame in frame.groupby([frame[idKey], frameDays], sort=False):
+				if day >= today:
+					incompleteFrames.append(dayFrame)
+					continue
+
+				dayDir = os.path.join(classDir, str(componentId))
+				os.makedirs(dayDir, exist_ok=True)
+
+				#Uncompressed so the files can be memory mapped when they are read back
+				feather.write_feather(dayFrame.reset_index(drop=True), os.path.join(dayDir, day.isoformat() + '.feather'), compression='uncompressed')
+
+		day = rangeStart
+
+		while day < rangeEnd:
+			if day < today:
+				if componentIds is None:
+					manifest['days'].add(day.isoformat())
+				else:
+					for componentId in componentIds:
+						manifest['components'].setdefault(str(componentId), set()).add(day.isoformat())
+
+			day += timedelta(days=1)
+
+	os.makedirs(classDir, exist_ok=True)
+	writeCacheManifest(classDir, manifest)
+
+	return incompleteFrames
+
+
+def loadCachedData(session, startTimestamp, endTimestamp, componentTypes = [], cacheDir='readings_cache', columns=None, componentIds=None):
+	"""Same as loadData but the readings are kept in a local cache of Feather files, <cacheDir>/<ReadingClass>/<componentId>/<day>.feather.
+
+	Only the days of the period that are not in the cache yet for the requested components are read from the
+	database, and only for those components (session can be None when the cache already has all of them). The cached files are read memory mapped, keeping only the requested columns
+	(attribute keys such as '_zoneTemperature', the timestamp and id columns are always kept) and componentIds.
+	The rows are ordered by component id and timestamp."""
+
+	dataFrames = dict()
+	startTimestamp = pd.Timestamp(startTimestamp)
+	endTimestamp = pd.Timestamp(endTimestamp)
+
+	for componentType in componentTypes:
+		componentReadingClass = getComponentReadingClassByType(componentType)
+		idKey = componentIdKey(componentReadingClass)
+		classDir = os.path.join(cacheDir, componentReadingClass.__name__)
+
+		days = list(pd.date_range(startTimestamp.normalize(), (endTimestamp - pd.Timedelta(microseconds=1)).normalize(), freq='D').date)
+		manifest = readCacheManifest(classDir)
+		completedDays = cachedDays(manifest, componentIds)
+		missingDays = [day for day in days if day.isoformat() not in completedDays]
+
+		frames = []
+
+		if missingDays != []:
+			if session is None:
+				raise ValueError('{} days of {} are not cached and there is no database session'.format(len(missingDays), componentType))
+
+			print('Caching {} days of {}'.format(len(missingDays), componentType))
+			frames = cacheMissingDays(session, componentReadingClass, missingDays, classDir, manifest, componentIds)
+
+		readColumns = None if columns is None else ['_timestamp', idKey] + [column for column in columns if column not in ('_timestamp', idKey)]
+		tables = []
+
+		componentDirs = os.listdir(classDir) if os.path.isdir(classDir) else []
+
+		if componentIds is not None:
+			componentDirs = [componentDir for componentDir in componentDirs if componentDir in {str(componentId) for componentId in componentIds}]
+
+		for componentDir in sorted(componentDirs, key=lambda componentDir: (len(componentDir), componentDir)):
+			for day in days:
+				dayPath = os.path.join(classDir, componentDir, day.isoformat() + '.feather')
+
+				if os.path.exists(dayPath):
+					tables.append(feather.read_table(dayPath, columns=readColumns, memory_map=True))
+
+		if tables != []:
+			frames.insert(0, pa.concat_tables(tables, promote_options='default').to_pandas())
+
+		if componentIds is not None:
+			frames = [frame.loc[frame[idKey].isin(componentIds)] for frame in frames]
+
+		if readColumns is not None:
+			frames = [frame[readColumns] for frame in frames]
+
+		frames = [frame for frame in frames if len(frame) > 0]
+
+		if frames != []:
+			frame = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+			frame = frame.loc[(frame['_timestamp'] >= startTimestamp) & (frame['_timestamp'] < endTimestamp)]
+			#The frames that are not cached (today's rows) come after the cached components
+			frame = frame.sort_values([idKey, '_timestamp'], kind='stable').reset_index(drop=True)
+
+			#Boolean columns are object columns in the days with nulls, get the dtype loadData would give them back
+			frame = frame.infer_objects()
+
+			if len(frame) > 0:
+				dataFrames[componentType] = frame
 
-		count += 1
-			
 	return dataFrames
 
 
-def reshapeAndCleanDataFrame(dataFrame, removeSetpoints=False, removeRequests=False, removeBooleans=False):
-	"""Reshape the dataframe and return the dataframe reshaped. For each dataframe keep only the data/features that may result useful for the analysis
-	for instance it makes no sense to keep boolean values since they are not drawn from a gaussian distribution but instead a binary distribution, 
-	and thus they can not be fitted into a gausssian one. Same with setpoints, they are fixed values."""
-
-	#clean dataframe and reshape it
-	df = dataFrame
-
-	newColumnNames = {column:column.replace('_', "") for column in df.columns}
-	df.rename(columns=newColumnNames, inplace=True)
-	
-	#Get the Id Column
-	idColumn = list(filter(lambda colName: 'Id' in colName or 'Number' in colName, newColumnNames.values()))
-	if len(idColumn) != 1:
-	    print('Could not determine Id Column')
-	else:
-	    idColumn = idColumn[0]
+def columnFlags(name, isPrimaryKey, isBoolean):
+	"""Return the cleaning flags of a column given its name (attribute key without '_'), if it is part of the primary key and if it holds booleans"""
 
-	indexColumns = ['timestamp']
+	lowerName = name.lower()
 
-	dataColumns = list(filter(lambda colName: idColumn != colName and colName != 'timestamp', newColumnNames.values()))
+	return {'timestamp': name == 'timestamp',
+		'id': isPrimaryKey and name != 'timestamp',
+		'setpoint': 'setpoint' in lowerName or 'stpnt' in lowerName or re.search('sp[0-9]*$', lowerName) is not None,
+		'request': 'request' in lowerName or 'req' in lowerName,
+		'boolean': isBoolean}
 
-	#Remove setpoint related columns
-	if removeSetpoints == True:
-		dropColumns = list(filter(lambda colName: 'setpoint' in colName.lower() or 'stpnt' in colName.lower(), newColumnNames.values()))
 
-	#Remove request related columns
-	if removeRequests == True:
-		dropColumns += list(filter(lambda colName: "request" in colName.lower() or "req" in colName.lower(), newColumnNames.values()))
+def columnMetadata(componentReadingClass):
+	"""Return the flags of every column of a reading class, keyed by the column name reshapeAndCleanDataFrame uses"""
 
-	#Remove boolean columns
-	if removeBooleans == True:
-		dropColumns += list(filter(lambda colName: df[colName].dtype == bool, newColumnNames.values()))
+	if componentReadingClass not in _columnMetadata:
+		_columnMetadata[componentReadingClass] = {columnProperty.key.replace('_', ''):
+			columnFlags(columnProperty.key.replace('_', ''), columnProperty.columns[0].primary_key, isinstance(columnProperty.columns[0].type, sqlalchemy.Boolean))
+			for columnProperty in class_mapper(componentReadingClass).column_attrs}
 
-	#drop the undesired columns
-	df.drop(dropColumns, axis=1, inplace=True)
-	
-	df.set_index(indexColumns, inplace=True)
-	df.dropna(axis=1, how='all', inplace=True)
+	return _columnMetadata[componentReadingClass]
 
-	currentColumns = df.columns.values.tolist()
 
-	currentColumns.remove(idColumn)
+def getComponentReadingClassByColumns(columns):
+	"""Return the reading class whose columns match the most columns of a dataframe, None if none of them has its id column"""
 
-	#when there is a -1 in the data, replace it by NaN
-	df.replace(-1, value=np.nan, inplace=True)
-	df.dropna(axis=0, how='all', inplace=True, subset=currentColumns)
-	#df.fillna(value=-1)
+	columnNames = {column.replace('_', '') for column in columns}
+	componentClass = None
+	bestMatches = 0
 
-	#dataFrames[dfkey].fillna(value=nan, inplace=True)
+	for componentType in ["AHU", "VFD", "Filter", "Damper", "Fan", "HEC", "SAV", "VAV", "Thermafuser"]:
+		componentReadingClass = getComponentReadingClassByType(componentType)
+		metadata = columnMetadata(componentReadingClass)
+		matches = len(columnNames & set(metadata))
 
-	return df
+		if any(flags['id'] and name in columnNames for name, flags in metadata.items()) and matches > bestMatches:
+			componentClass, bestMatches = componentReadingClass, matches
+
+	return componentClass
 
 
+def reshapeAndCleanDataFrame(dataFrame, removeSetpoints=False, removeRequests=False, removeBooleans=False, componentReadingClass=None):
+	"""Reshape the dataframe and return the dataframe reshaped. For each dataframe keep only the data/features that may result useful for the analysis
+	for instance it makes no sense to keep boolean values since they are not drawn from a gaussian distribution but instead a binary distribution, 
+	and thus they can not be fitted into a gausssian one. Same with setpoints, they are fixed values.
+
+	Which columns are setpoints, requests, booleans or the id is taken from hvacDBMapping (componentReadingClass is guessed
+	from the columns if not given, the names are used for columns that are not mapped). Each column is converted once:
+	numbers become float32 with -1 replaced by NaN, booleans nullable booleans, text categoricals and the id the
+	smallest integer type that fits. The input dataframe is not modified."""
+
+	bytesBefore = dataFrame.memory_usage(deep=True).sum()
+
+	if componentReadingClass is None:
+		componentReadingClass = getComponentReadingClassByColumns(dataFrame.columns)
+
+	metadata = columnMetadata(componentReadingClass) if componentReadingClass is not None else dict()
+
+	idColumn = None
+	columns = dict()
+
+	for column in dataFrame.columns:
+		name = column.replace('_', "")
+		values = dataFrame[column]
+		flags = metadata.get(name)
+
+		if flags is None:
+			flags = columnFlags(name, 'Id' in name or 'Number' in name, pd.api.types.is_bool_dtype(values))
+
+		#Remove the undesired columns
+		if (removeSetpoints and flags['setpoint']) or (removeRequests and flags['request']) or (removeBooleans and flags['boolean']):
+			continue
+
+		if flags['timestamp']:
+			columns[name] = values.to_numpy()
+		elif flags['id']:
+			idColumn = name
+			columns[name] = pd.to_numeric(values, downcast='integer').to_numpy()
+		elif flags['boolean']:
+			columns[name] = values.astype('boolean').array
+		elif pd.api.types.is_numeric_dtype(values):
+			#when there is a -1 in the data, replace it by NaN
+			array = values.to_numpy(dtype=np.float32, na_value=np.nan)
+			array[array == -1] = np.nan
+			columns[name] = array
+		else:
+			columns[name] = values.astype('category').array
+
+	if idColumn is None:
+		print('Could not determine Id Column')
+
+	df = pd.DataFrame(columns, copy=False)
+	df.set_index('timestamp', inplace=True)
+	df.dropna(axis=1, how='all', inplace=True)
 
+	currentColumns = [column for column in df.columns if column != idColumn]
 
+	df.dropna(axis=0, how='all', inplace=True, subset=currentColumns)
 
+	print('Reshaped dataframe uses {} bytes, {} bytes saved'.format(df.memory_usage(deep=True).sum(), bytesBefore - df.memory_usage(deep=True).sum()))
 
+	return df
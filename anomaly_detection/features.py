@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from collections import deque
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Features of the thermafuser model, in the order the model was fitted with
+FEATURE_COLUMNS = ['AirflowRoll', 'SupplyAirRoll', 'ZoneTemperatureRoll', '0-5Roll', '6-11Roll', '12-17Roll', '18-23Roll']
+
+# Rolling window of the measure means and of the day quarter medians (0-5, 6-11, 12-17, 18-23)
+MEAN_WINDOW = 12
+QUARTER_WINDOWS = [12, 12, 12, 21]
+
+
+def day_quarters(times):
+    """Return the day quarter (0 to 3) of every timestamp, the categories are fixed so every quarter always has its column"""
+
+    return (pd.DatetimeIndex(pd.to_datetime(times)).hour.to_numpy() // 6).astype(np.int64)
+
+
+def window_means(windows):
+    """Mean of every row of a (rows x window) array, NaN when the row holds a NaN (as pandas rolling().mean()).
+
+    Batch and streaming modes both reduce the windows here, so they give the exact same numbers."""
+
+    return windows.sum(axis=1) / windows.shape[1]
+
+
+def window_indicator_medians(windows):
+    """Median of every row of a (rows x window) array of 0/1 indicators.
+
+    A row sorted is (window - ones) zeros followed by ones, so the middle elements follow from the number of ones."""
+
+    window = windows.shape[1]
+    zeros = window - windows.sum(axis=1)
+
+    return ((((window - 1) // 2) >= zeros).astype(np.float64) + ((window // 2) >= zeros)) / 2
+
+
+def rolling(values, window, reduce):
+    """Apply reduce to every window of values ending at each position, the first window - 1 positions are NaN"""
+
+    result = np.full(len(values), np.nan)
+
+    if len(values) >= window:
+        result[window - 1:] = reduce(sliding_window_view(values, window))
+
+    return result
+
+
+def batch_features(times, airflow_feedback, supply_air, zone_temperature, index=None, dropna=True):
+    """Compute the features of the readings of one component, ordered by time, in one vectorized pass.
+
+    Return a DataFrame with the FEATURE_COLUMNS, indexed by index (the index of times when it is a Series,
+    positions otherwise). With dropna the rows whose windows are not complete yet are left out."""
+
+    if index is None:
+        index = times.index if isinstance(times, pd.Series) else pd.RangeIndex(len(times))
+
+    quarters = day_quarters(times)
+    columns = {}
+
+    for name, values in zip(FEATURE_COLUMNS[:3], (airflow_feedback, supply_air, zone_temperature)):
+        columns[name] = rolling(np.asarray(values, dtype=np.float64), MEAN_WINDOW, window_means)
+
+    for quarter, (name, window) in enumerate(zip(FEATURE_COLUMNS[3:], QUARTER_WINDOWS)):
+        columns[name] = rolling((quarters == quarter).astype(np.float64), window, window_indicator_medians)
+
+    features = pd.DataFrame(columns, index=index)
+
+    return features.dropna() if dropna else features
+
+
+class StreamingFeatures:
+    """Computes the features of one component a reading at a time, with the same numbers as batch_features.
+
+    The state (the last readings of every window) can be saved with to_state and restored with from_state."""
+
+    def __init__(self):
+
+        self.history = max([MEAN_WINDOW] + QUARTER_WINDOWS)
+        self.measures = [deque(maxlen=self.history) for i in range(3)]
+        self.quarters = deque(maxlen=self.history)
+
+    def push(self, time, airflow_feedback, supply_air, zone_temperature):
+        """Add a reading, return its features (a list in FEATURE_COLUMNS order) or None while a window is not complete"""
+
+        for measure, value in zip(self.measures, (airflow_feedback, supply_air, zone_temperature)):
+            measure.append(float(value))
+
+        self.quarters.append(int(pd.Timestamp(time).hour // 6))
+
+        if len(self.quarters) < self.history:
+            return None
+
+        row = [window_means(np.array(measure, dtype=np.float64)[None, -MEAN_WINDOW:])[0] for measure in self.measures]
+        quarters = np.array(self.quarters)
+
+        for quarter, window in enumerate(QUARTER_WINDOWS):
+            row.append(window_indicator_medians((quarters[None, -window:] == quarter).astype(np.float64))[0])
+
+        return None if np.isnan(row).any() else row
+
+    def to_state(self):
+
+        return {'measures': [list(measure) for measure in self.measures], 'quarters': list(self.quarters)}
+
+    @classmethod
+    def from_state(cls, state):
+
+        streaming = cls()
+
+        for measure, values in zip(streaming.measures, state['measures']):
+            measure.extend(values)
+
+        streaming.quarters.extend(state['quarters'])
+
+        return streaming
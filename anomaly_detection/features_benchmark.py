@@ -0,0 +1,98 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+
+import features
+
+
+def legacy_features(res_df):
+    """The feature pipeline input_fn used before the features module, kept to compare against"""
+
+    day_quarters = {0: '0-5', 1: '6-11', 2: '12-17', 3: '18-23'}
+
+    # To ensure that all of the quarters are created
+    fake_entries = {'time': [None, None, None, None], 'airflowFeedback': [None, None, None, None],
+                    'supplyAir': [None, None, None, None], 'zoneTemperature': [None, None, None, None],
+                    'Day quarter': [0, 1, 2, 3]
+                    }
+    quarters_df = pd.DataFrame(fake_entries)
+
+    res_df['time'] = pd.to_datetime(res_df['time'])
+    res_df['Day quarter'] = res_df['time'].map(lambda x: x.hour // 6)
+    concat_df = pd.concat([res_df, quarters_df], axis=0)
+    dummies = pd.get_dummies(concat_df['Day quarter'])
+    concat_df = pd.concat([concat_df, dummies], axis=1)
+    concat_df.rename(columns=day_quarters, inplace=True)
+
+    concat_df = concat_df.dropna(axis=0, subset=['time'])
+
+    concat_df['AirflowRoll'] = concat_df['airflowFeedback'].rolling(window=12).mean()
+    concat_df['SupplyAirRoll'] = concat_df['supplyAir'].rolling(window=12).mean()
+    concat_df['ZoneTemperatureRoll'] = concat_df['zoneTemperature'].rolling(window=12).mean()
+
+    concat_df['0-5Roll'] = concat_df['0-5'].rolling(window=12).median()
+    concat_df['6-11Roll'] = concat_df['6-11'].rolling(window=12).median()
+    concat_df['12-17Roll'] = concat_df['12-17'].rolling(window=12).median()
+    concat_df['18-23Roll'] = concat_df['18-23'].rolling(window=21).median()
+
+    return concat_df[features.FEATURE_COLUMNS].dropna()
+
+
+def synthetic_readings(rows, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({'time': pd.date_range('2018-07-11', periods=rows, freq='5min'),
+                         'airflowFeedback': rng.normal(300, 20, rows), 'supplyAir': rng.normal(55, 2, rows),
+                         'zoneTemperature': rng.normal(72, 1, rows)})
+
+
+def timed(function, repeat):
+
+    best = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return result, best
+
+
+def streaming_features(res_df):
+
+    streaming = features.StreamingFeatures()
+    rows = []
+
+    for reading in res_df.itertuples(index=False):
+        row = streaming.push(reading.time, reading.airflowFeedback, reading.supplyAir, reading.zoneTemperature)
+
+        if row is not None:
+            rows.append(row)
+
+    return np.array(rows)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[120, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        res_df = synthetic_readings(rows)
+
+        legacy, legacy_secs = timed(lambda: legacy_features(res_df.copy()), args.repeat)
+        batch, batch_secs = timed(lambda: features.batch_features(res_df['time'], res_df['airflowFeedback'],
+                                                                   res_df['supplyAir'], res_df['zoneTemperature']), args.repeat)
+        streaming, streaming_secs = timed(lambda: streaming_features(res_df), 1)
+
+        assert np.array_equal(batch.to_numpy(), streaming), 'batch and streaming features differ'
+        assert batch.index.equals(legacy.index), 'batch and legacy features have different rows'
+
+        print('{} rows: legacy {:.4f}s, batch {:.4f}s ({:.1f}x), streaming {:.4f}s ({:.1f} us/reading), max difference with legacy {:.3g}'.format(
+            rows, legacy_secs, batch_secs, legacy_secs / batch_secs, streaming_secs, 1e6 * streaming_secs / rows,
+            np.abs(batch.to_numpy() - legacy.to_numpy().astype(np.float64)).max()))
@@ -0,0 +1,141 @@
+import json
+import os
+import numpy as np
+
+
+# Arrays of a flattened forest, one .npy file each, see export_forest
+FOREST_ARRAYS = ['children_left', 'children_right', 'feature', 'threshold', 'missing_go_to_left', 'leaf_value', 'roots']
+
+
+def export_forest(clf, path):
+    """Flatten the trees of a fitted IsolationForest into contiguous arrays saved as .npy files in path.
+
+    The nodes of all the trees are concatenated (roots has the index of the root of every tree) and the children
+    indices point into the concatenated arrays. feature is the column of X each node tests, already mapped through
+    estimators_features_, and leaf_value is the depth of the node plus the average path length of its samples
+    minus one, computed as IsolationForest does. meta.json has what is needed to turn depths into scores."""
+
+    from sklearn.ensemble._iforest import _average_path_length
+
+    os.makedirs(path, exist_ok=True)
+
+    subsample_features = clf._max_features != clf.n_features_in_
+    arrays = {name: [] for name in FOREST_ARRAYS}
+    offset = 0
+    max_depth = 0
+
+    for tree_idx, (estimator, features) in enumerate(zip(clf.estimators_, clf.estimators_features_)):
+        tree = estimator.tree_
+        is_leaf = tree.children_left == -1
+
+        feature = np.where(is_leaf, -1, tree.feature).astype(np.int64)
+
+        if subsample_features:
+            feature[~is_leaf] = np.asarray(features)[feature[~is_leaf]]
+
+        if hasattr(tree, 'missing_go_to_left'):
+            missing_go_to_left = tree.missing_go_to_left.astype(bool)
+        else:
+            # Without missing value support a NaN fails the <= test and goes right
+            missing_go_to_left = np.zeros(tree.node_count, dtype=bool)
+
+        arrays['children_left'].append(np.where(is_leaf, -1, tree.children_left + offset))
+        arrays['children_right'].append(np.where(is_leaf, -1, tree.children_right + offset))
+        arrays['feature'].append(feature)
+        arrays['threshold'].append(tree.threshold.astype(np.float64))
+        arrays['missing_go_to_left'].append(missing_go_to_left)
+        arrays['leaf_value'].append(clf._decision_path_lengths[tree_idx] + clf._average_path_length_per_tree[tree_idx] - 1.0)
+        arrays['roots'].append(np.array([offset]))
+
+        offset += tree.node_count
+        max_depth = max(max_depth, tree.max_depth)
+
+    for name, parts in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(np.concatenate(parts)))
+
+    meta = {'n_estimators': len(clf.estimators_), 'n_features': int(clf.n_features_in_), 'max_depth': int(max_depth),
+            'denominator': float(len(clf.estimators_) * _average_path_length([clf._max_samples])[0]),
+            'offset': float(clf.offset_)}
+
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+
+class ForestArtifact:
+    """IsolationForest scorer over the arrays written by export_forest, loaded memory mapped.
+
+    All the trees are walked at once, one level per step, and the leaf values are added tree after tree in the
+    same order as sklearn, so score_samples, decision_function and predict match IsolationForest exactly."""
+
+    def __init__(self, arrays, meta, chunk_rows=4096):
+
+        for name in FOREST_ARRAYS:
+            setattr(self, name, arrays[name])
+
+        self.meta = meta
+        self.offset_ = meta['offset']
+        self.chunk_rows = chunk_rows
+
+    @classmethod
+    def load(cls, path, chunk_rows=4096):
+
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in FOREST_ARRAYS}
+
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+
+        return cls(arrays, meta, chunk_rows)
+
+    def _depths(self, X):
+
+        n_samples = X.shape[0]
+        rows = np.arange(n_samples)[None, :]
+        node = np.repeat(np.asarray(self.roots)[:, None], n_samples, axis=1)
+
+        for level in range(self.meta['max_depth']):
+            left = self.children_left[node]
+            active = left != -1
+
+            if not active.any():
+                break
+
+            feature = self.feature[node]
+            values = X[rows, np.where(active, feature, 0)]
+
+            with np.errstate(invalid='ignore'):
+                go_left = np.where(np.isnan(values), self.missing_go_to_left[node], values <= self.threshold[node])
+
+            node = np.where(active, np.where(go_left, left, self.children_right[node]), node)
+
+        leaf_values = self.leaf_value[node]
+        depths = np.zeros(n_samples)
+
+        # Tree after tree, as IsolationForest accumulates them
+        for tree_values in leaf_values:
+            depths += tree_values
+
+        return depths
+
+    def score_samples(self, X):
+
+        # IsolationForest works on float32 samples
+        X = np.asarray(X, dtype=np.float32)
+        depths = np.concatenate([self._depths(X[start:start + self.chunk_rows]) for start in range(0, X.shape[0], self.chunk_rows)]) \
+            if X.shape[0] > 0 else np.zeros(0)
+
+        denominator = self.meta['denominator']
+        scores = 2 ** (-np.divide(depths, denominator, out=np.ones_like(depths), where=denominator != 0))
+
+        return -scores
+
+    def decision_function(self, X):
+
+        return self.score_samples(X) - self.offset_
+
+    def predict(self, X):
+
+        decision_func = self.decision_function(X)
+        is_inlier = np.ones_like(decision_func, dtype=int)
+        is_inlier[decision_func < 0] = -1
+
+        return is_inlier
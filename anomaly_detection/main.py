@@ -13,9 +13,11 @@ if __name__ == '__main__':
     #print(thermafuser_ahu.shape)
     #thermafuser_df.to_csv('thermafuser_readings.csv')
 
-    thermafuser_df = pd.read_csv('thermafuser_readings.csv', low_memory=False, index_col=False)
-    thermafuser_df = thermafuser_df.drop('Unnamed: 0', axis=1)
-    thermafuser_df = thermafuser_df.loc[thermafuser_df['_thermafuserId'] == 1]
+    # Only the days missing from readings_cache/ are read from the database, the rest is memory mapped from the cache
+    db_session = dataManagement.getDBSession('hvac2018_04', 'factory2.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'admin', 'Dexsys131')
+    results = dataManagement.loadCachedData(session=db_session, startTimestamp='2018-07-11', endTimestamp='2018-10-11',
+                                            componentTypes=['Thermafuser'], componentIds=[1])
+    thermafuser_df = results['Thermafuser']
 
     print(thermafuser_df.head())
     print(thermafuser_df.shape)
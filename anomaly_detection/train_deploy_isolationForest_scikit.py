@@ -1,117 +1,247 @@
 import argparse
+import concurrent.futures
 import os
+import time
 import pandas as pd
 import numpy as np
 import joblib
 import json
 import pickle
+import shutil
+import tempfile
 
-from io import StringIO
+from io import BytesIO, StringIO
 
 from sklearn.ensemble import IsolationForest
 
+import features
+import forest_artifact
+
 from sagemaker_containers.beta.framework import content_types, encoders, env, modules, transformer, worker
 
 
 
+# Columns of the readings the training uses and their dtypes, the timestamps are parsed after reading
+TRAINING_DTYPES = {'_timestamp': 'str', '_airflowFeedback': 'float64', '_supplyAir': 'float64', '_zoneTemperature': 'float64'}
+
+
+def iter_training_chunks(train_dir, component_column='_thermafuserId', component_ids=None, chunksize=500000, prefer_parquet=True):
+    """Yield the training columns of every CSV/Parquet file of the training channel, chunksize rows at a time.
+
+    Only the TRAINING_DTYPES columns and the component column are read, with explicit dtypes, and the timestamps
+    of each chunk are parsed as it is read. CSV files are read with the C parser and Parquet files batch by batch
+    with pyarrow, keeping only the rows of component_ids (all of them if None) from each chunk. With
+    prefer_parquet, a CSV that has a Parquet file of the same name next to it is read from the Parquet."""
+
+    import pyarrow.dataset as ds
+
+    dtypes = dict(TRAINING_DTYPES, **{component_column: 'int64'})
+    columns = list(dtypes)
+    files = sorted(os.listdir(train_dir))
+
+    for file in files:
+        path = os.path.join(train_dir, file)
+        name, extension = os.path.splitext(file)
+
+        if extension == '.parquet':
+            dataset = ds.dataset(path, format='parquet')
+            row_filter = ds.field(component_column).isin(component_ids) if component_ids else None
+            chunks = (batch.to_pandas().astype({column: dtype for column, dtype in dtypes.items() if column != '_timestamp'})
+                      for batch in dataset.to_batches(columns=columns, filter=row_filter, batch_size=chunksize))
+
+        elif extension == '.csv':
+            if prefer_parquet and name + '.parquet' in files:
+                continue
+
+            chunks = pd.read_csv(path, usecols=columns, dtype=dtypes, engine='c', chunksize=chunksize)
+
+        else:
+            continue
+
+        for chunk in chunks:
+            if component_ids and extension == '.csv':
+                chunk = chunk.loc[chunk[component_column].isin(component_ids)]
+
+            # Parquet files may already store the timestamps typed, to_datetime leaves them as they are
+            chunk['_timestamp'] = pd.to_datetime(chunk['_timestamp'])
+
+            yield chunk
+
+
+def read_training_data(train_dir, component_column='_thermafuserId', component_ids=None, chunksize=500000, prefer_parquet=True):
+    """Read the training columns of the training channel into a single DataFrame, see iter_training_chunks.
+
+    The whole DataFrame is held in memory, so it is bounded by the rows of component_ids only when they are given.
+    partition_training_data splits the channel by component on disk instead."""
+
+    frames = list(iter_training_chunks(train_dir, component_column, component_ids, chunksize, prefer_parquet))
+
+    if not frames:
+        dtypes = dict(TRAINING_DTYPES, _timestamp='datetime64[ns]', **{component_column: 'int64'})
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def partition_training_data(train_dir, partition_dir, component_column='_thermafuserId', component_ids=None, chunksize=500000,
+                            prefer_parquet=True):
+    """Split the training channel by component into partition_dir/<component id>/<chunk>.parquet, one chunk in
+    memory at a time, and return the sorted ids of the components written. See iter_training_chunks."""
+
+    written = set()
+
+    for chunk_number, chunk in enumerate(iter_training_chunks(train_dir, component_column, component_ids, chunksize, prefer_parquet)):
+        for component_id, component_df in chunk.groupby(component_column, sort=False):
+            component_dir = os.path.join(partition_dir, str(component_id))
+            os.makedirs(component_dir, exist_ok=True)
+            component_df.drop(component_column, axis=1).to_parquet(os.path.join(component_dir, '{:06d}.parquet'.format(chunk_number)), index=False)
+            written.add(int(component_id))
+
+    return sorted(written)
+
+
+def component_training_features(thermafuser_df):
+    """Return the training features of the readings of one component"""
+
+    col_names = {'_roomOccupied': 'RoomOccupied', '_supplyAir': 'SupplyAir',
+                 '_occupiedCoolingSetpoint': 'OccupiedCoolingSetpoint', '_terminalLoad': 'TerminalLoad',
+                 '_zoneTemperature': 'ZoneTemperature', '_airflowFeedback': 'AirflowFeedback',
+                 '_occupiedHeatingSetpoint': 'OccupiedHeatingSetpoint', '_timestamp': 'Timestamp'}
+
+    thermafuser_df = thermafuser_df.rename(columns=col_names)
+    thermafuser_df['Timestamp'] = pd.to_datetime(thermafuser_df['Timestamp'])
+    thermafuser_df = thermafuser_df.sort_values('Timestamp').reset_index(drop=True)
+
+    thermafuser_df.drop(0, axis=0, inplace=True)
+
+    #Create rolling windows
+    return features.batch_features(thermafuser_df['Timestamp'], thermafuser_df['AirflowFeedback'],
+                                   thermafuser_df['SupplyAir'], thermafuser_df['ZoneTemperature'])
+
+
+def fit_component_model(component_id, train_df, model_dir, n_estimators, contamination, max_features):
+    """Fit the model of one component and save it to model_dir/models/<component_id>, run in a worker process"""
+
+    start = time.perf_counter()
+
+    clf = IsolationForest(n_estimators=n_estimators, max_samples='auto', contamination=contamination, max_features=max_features,
+                          bootstrap=False, n_jobs=1, verbose=0)
+    clf.fit(train_df)
+
+    fit_secs = time.perf_counter() - start
+
+    component_dir = os.path.join(model_dir, 'models', str(component_id))
+    os.makedirs(component_dir, exist_ok=True)
+    joblib.dump(clf, os.path.join(component_dir, "model.joblib"))
+
+    # Flattened copy of the trees, model_fn memory maps it instead of unpickling the model
+    forest_artifact.export_forest(clf, os.path.join(component_dir, "forest"))
+
+    return component_id, len(train_df), fit_secs
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
 
-    day_quarters = {0: '0-5', 1: '6-11', 2: '12-17', 3: '18-23'}
-
     # Hyperparameters are described here. In this simple example we are just including one hyperparameter.
     parser.add_argument('--n_estimators', type=int, default=100)
     parser.add_argument('--contamination', type=float, default=0.1)
     parser.add_argument('--max_features', type=float, default=1.0)
 
+    # One model is fitted per component, in parallel
+    parser.add_argument('--component-column', type=str, default='_thermafuserId')
+    parser.add_argument('--component-ids', type=int, nargs='*', default=None, help='Components to train, all of them by default')
+    parser.add_argument('--min-rows', type=int, default=100, help='Components with fewer training rows are skipped')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=500000, help='Rows per chunk read from the input files')
+    parser.add_argument('--no-parquet', action='store_true', help='Read the CSV files even when there is a Parquet copy next to them')
+
     # Sagemaker specific arguments. Defaults are set in the environment variables.
-    parser.add_argument('--output-data-dir', type=str, default=os.environ['SM_OUTPUT_DATA_DIR'])
-    parser.add_argument('--model-dir', type=str, default=os.environ['SM_MODEL_DIR'])
-    parser.add_argument('--train', type=str, default=os.environ['SM_CHANNEL_TRAIN'])
+    parser.add_argument('--output-data-dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR'))
+    parser.add_argument('--model-dir', type=str, default=os.environ.get('SM_MODEL_DIR'))
+    parser.add_argument('--train', type=str, default=os.environ.get('SM_CHANNEL_TRAIN'))
 
     args = parser.parse_args()
 
     print(args.train)
 
-    input_files = [os.path.join(args.train, file) for file in os.listdir(args.train)]
+    # The readings are split by component on disk first so that only the readings of one component are in memory
+    partition_dir = tempfile.mkdtemp(prefix='training_partitions_')
+    partition_component_ids = partition_training_data(args.train, partition_dir, args.component_column, args.component_ids,
+                                                      args.chunksize, not args.no_parquet)
 
-    thermafuser_df = pd.read_csv(input_files[0], index_col=False, engine='python')
-    thermafuser_df = thermafuser_df.drop('Unnamed: 0', axis=1)
-    thermafuser_df = thermafuser_df.loc[thermafuser_df['_thermafuserId'] == 1]
-    thermafuser_df.reset_index(inplace=True, drop=True)
+    start = time.perf_counter()
+    index = {'component_column': args.component_column, 'default': None, 'components': {}}
 
-    col_names = {'_roomOccupied': 'RoomOccupied', '_supplyAir': 'SupplyAir',
-                 '_occupiedCoolingSetpoint': 'OccupiedCoolingSetpoint', '_terminalLoad': 'TerminalLoad',
-                 '_zoneTemperature': 'ZoneTemperature', '_airflowFeedback': 'AirflowFeedback',
-                 '_occupiedHeatingSetpoint': 'OccupiedHeatingSetpoint', '_timestamp': 'Timestamp'}
+    def record_fit(future):
+        component_id, rows, fit_secs = future.result()
+        index['components'][str(component_id)] = {'path': os.path.join('models', str(component_id)), 'rows': rows, 'fit_secs': fit_secs}
+        print('Component {}: {} rows fitted in {:.2f}s'.format(component_id, rows, fit_secs))
 
-    thermafuser_df = thermafuser_df.drop('_thermafuserId', axis=1)
-    thermafuser_df = thermafuser_df.rename(columns=col_names)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = set()
 
-    thermafuser_df['Timestamp'] = pd.to_datetime(thermafuser_df['Timestamp'])
+        for component_id in partition_component_ids:
+            train_df = component_training_features(pd.read_parquet(os.path.join(partition_dir, str(component_id))))
 
-    thermafuser_df['RoomOccupied'] = thermafuser_df['RoomOccupied'].replace({True: 1, False: 0})
-    thermafuser_df = thermafuser_df.drop(['OccupiedCoolingSetpoint', 'OccupiedHeatingSetpoint', 'TerminalLoad'], axis=1)
+            if len(train_df) < args.min_rows:
+                print('Skipping component {}, only {} training rows'.format(component_id, len(train_df)))
+                continue
 
-    thermafuser_df = thermafuser_df.drop('RoomOccupied', axis=1)
+            # At most two fits per worker are queued, so the features of every component are not held at once
+            if len(futures) >= 2 * args.workers:
+                done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
 
-    thermafuser_df['Day quarter'] = thermafuser_df['Timestamp'].map(lambda x: x.hour // 6)
-    dummies = pd.get_dummies(thermafuser_df['Day quarter'])
-    thermafuser_df = pd.concat([thermafuser_df, dummies], axis=1)
-    thermafuser_df.rename(columns=day_quarters, inplace=True)
+                for future in done:
+                    record_fit(future)
 
-    thermafuser_df.drop(0, axis=0, inplace=True)
-    thermafuser_df.drop('Day quarter', axis=1, inplace=True)
-    thermafuser_df.drop('Timestamp', axis=1, inplace=True)
+            futures.add(executor.submit(fit_component_model, int(component_id), train_df, args.model_dir,
+                                        args.n_estimators, args.contamination, args.max_features))
 
-    #Create time window
+        for future in concurrent.futures.as_completed(futures):
+            record_fit(future)
 
-    thermafuser_df_windowed = thermafuser_df.copy()
+    shutil.rmtree(partition_dir, ignore_errors=True)
 
-    #Create rolling windows
-    thermafuser_df_windowed['AirflowRoll'] = thermafuser_df['AirflowFeedback'].rolling(window=12).mean()
-    thermafuser_df_windowed['SupplyAirRoll'] = thermafuser_df['SupplyAir'].rolling(window=12).mean()
-    thermafuser_df_windowed['ZoneTemperatureRoll'] = thermafuser_df['ZoneTemperature'].rolling(window=12).mean()
+    # Without any model the endpoint could not score anything, the job fails instead of writing an empty index
+    if not index['components']:
+        raise ValueError('No component has {} training rows (--min-rows), no model was trained'.format(args.min_rows))
 
-    thermafuser_df_windowed['0-5Roll'] = thermafuser_df['0-5'].rolling(window=12).median()
-    thermafuser_df_windowed['6-11Roll'] = thermafuser_df['6-11'].rolling(window=12).median()
-    thermafuser_df_windowed['12-17Roll'] = thermafuser_df['12-17'].rolling(window=12).median()
-    thermafuser_df_windowed['18-23Roll'] = thermafuser_df['18-23'].rolling(window=21).median()
+    # The component with the most training data scores the requests that do not say which component they are for
+    index['default'] = max(index['components'], key=lambda component_id: index['components'][component_id]['rows'])
 
-    thermafuser_df_windowed = thermafuser_df_windowed[['AirflowRoll', 'SupplyAirRoll', 'ZoneTemperatureRoll',
-                                                       '0-5Roll', '6-11Roll', '12-17Roll', '18-23Roll']]
-    thermafuser_df_windowed = thermafuser_df_windowed.dropna()
+    with open(os.path.join(args.model_dir, 'index.json'), 'w') as index_file:
+        json.dump(index, index_file, indent=2, sort_keys=True)
 
-    train_df = thermafuser_df_windowed[['AirflowRoll', 'SupplyAirRoll', 'ZoneTemperatureRoll', '0-5Roll', '6-11Roll', '12-17Roll', '18-23Roll']]
+    print('{} models trained with {} workers in {:.2f}s'.format(len(index['components']), args.workers, time.perf_counter() - start))
 
-    clf = IsolationForest(n_estimators=args.n_estimators, max_samples='auto', contamination=args.contamination, max_features=args.max_features,
-                          bootstrap=False, n_jobs=1, verbose=1)
-    clf.fit(train_df)
 
-    # Save the model to the location specified by args.model_dir
-    joblib.dump(clf, os.path.join(args.model_dir, "model.joblib"))
+# Content type of the batched requests of the predict Lambda, see input_fn
+BATCH_CONTENT_TYPE = 'application/x-npz'
+FEATURE_COLUMNS = features.FEATURE_COLUMNS
 
 
-def input_fn(input_data, content_type):
-    """Parse input data payload
+def compute_features(res_df):
+    """Compute the rolling window features of the readings of one component, res_df has a time column and the
+    airflowFeedback, supplyAir and zoneTemperature measures ordered by time. See features.batch_features"""
+
+    return features.batch_features(res_df['time'], res_df['airflowFeedback'], res_df['supplyAir'], res_df['zoneTemperature'])
 
-    We currently only take csv input. Since we need to process both labelled
-    and unlabelled data we first determine whether the label column is present
-    by looking at how many columns were provided.
-    """
 
-    day_quarters = {0: '0-5', 1: '6-11', 2: '12-17', 3: '18-23'}
+def input_fn(input_data, content_type):
+    """Parse input data payload
 
-    # To ensure that all of the quarters are created
-    fake_entries = {'time': [None, None, None, None], 'airflowFeedback': [None, None, None, None],
-                    'occupiedCoolingSetpoint': [None, None, None, None], 'roomOccupied': [None, None, None, None],
-                    'roomOccupied': [None, None, None, None], 'supplyAir': [None, None, None, None],
-                    'terminalLoad': [None, None, None, None], 'zoneTemperature': [None, None, None, None],
-                    'Day quarter': [0, 1, 2, 3]
-                    }
-    quarters_df = pd.DataFrame(fake_entries)
+    application/json carries the pivoted readings of a single component (DataFrame.to_json), the features are
+    returned as a DataFrame.
 
+    application/x-npz carries the readings of several components in one numpy .npz archive: component_ids (n),
+    offsets (n + 1, the rows of component i are offsets[i]:offsets[i + 1]), time (datetime64[ns] as int64) and
+    one array per measure. The features of each component are computed separately and returned as a dict with
+    the component ids and the features of every component, see predict_fn. When the archive has a features
+    array (rows x FEATURE_COLUMNS) instead of the readings, the features were computed incrementally by the
+    caller and are only split by component.
+    """
 
     if content_type == 'text/csv':
         # Read the raw input data as CSV.
@@ -125,38 +255,36 @@ def input_fn(input_data, content_type):
         #print(input_data)
 
         payload = json.loads(input_data)
-        res_df = pd.read_json(payload)
+        res_df = pd.read_json(StringIO(payload))
         print(res_df.head())
         res_df = res_df.reset_index()
 
-        #Create day quarters
-        res_df['time'] = pd.to_datetime(res_df['time'])
-        res_df['Day quarter'] = res_df['time'].map(lambda x: x.hour // 6)
-        concat_df = pd.concat([res_df, quarters_df], axis=0)
-        dummies = pd.get_dummies(concat_df['Day quarter'])
-        concat_df = pd.concat([concat_df, dummies], axis=1)
-        concat_df.rename(columns=day_quarters, inplace=True)
+        return compute_features(res_df)
+
+    elif content_type == BATCH_CONTENT_TYPE:
 
-        #Delete fake quarter entries
-        concat_df = concat_df.dropna(axis=0, subset=['time'])
+        batch = np.load(BytesIO(input_data), allow_pickle=False)
+        component_ids = batch['component_ids']
+        offsets = batch['offsets']
 
-        #Create rolling windows
-        concat_df['AirflowRoll'] = concat_df['airflowFeedback'].rolling(window=12).mean()
-        concat_df['SupplyAirRoll'] = concat_df['supplyAir'].rolling(window=12).mean()
-        concat_df['ZoneTemperatureRoll'] = concat_df['zoneTemperature'].rolling(window=12).mean()
+        if 'features' in batch.files:
+            feature_rows = pd.DataFrame(batch['features'], columns=FEATURE_COLUMNS)
 
-        concat_df['0-5Roll'] = concat_df['0-5'].rolling(window=12).median()
-        concat_df['6-11Roll'] = concat_df['6-11'].rolling(window=12).median()
-        concat_df['12-17Roll'] = concat_df['12-17'].rolling(window=12).median()
-        concat_df['18-23Roll'] = concat_df['18-23'].rolling(window=21).median()
+            return {'component_ids': component_ids.tolist(),
+                    'features': [feature_rows.iloc[offsets[i]:offsets[i + 1]] for i in range(len(component_ids))]}
 
-        #Keep only the interesting columns
+        measures = [name for name in batch.files if name not in ('component_ids', 'offsets', 'time')]
+        columns = {name: batch[name] for name in ['time'] + measures}
 
-        predict_df = concat_df[['AirflowRoll', 'SupplyAirRoll', 'ZoneTemperatureRoll', '0-5Roll', '6-11Roll', '12-17Roll', '18-23Roll']]
-        predict_df = predict_df.dropna()
+        segment_features = []
 
-        return predict_df
+        for i in range(len(component_ids)):
+            segment = slice(offsets[i], offsets[i + 1])
+            res_df = pd.DataFrame({name: values[segment] for name, values in columns.items()})
+            res_df['time'] = res_df['time'].astype('datetime64[ns]')
+            segment_features.append(compute_features(res_df))
 
+        return {'component_ids': component_ids.tolist(), 'features': segment_features}
 
     else:
         raise ValueError("{} not supported by script!".format(content_type))
@@ -170,8 +298,10 @@ def output_fn(prediction, response_content_type):
     container can read the response payload correctly.
     """
     if response_content_type == "application/json":
-        print('json return')
-        return("json content type")
+        # Batched predictions are a dict of lists keyed by component id, single ones a numpy array
+        json_output = prediction if isinstance(prediction, dict) else prediction.tolist()
+
+        return worker.Response(json.dumps(json_output), mimetype=response_content_type)
     elif response_content_type == 'text/csv':
         print("csv return")
         return "csv content type"
@@ -195,13 +325,78 @@ def predict_fn(input_data, model):
     The output is returned in the following order:
 
         rest of features either one hot encoded or standardized
+
+    A batch from input_fn is scored with a single predict call over the features of all its components, the
+    predictions are returned as a dict of lists keyed by component id (as a string). With a ModelBundle each
+    component is scored by its own model, the components without one by the default model of the bundle.
     """
+    if isinstance(input_data, dict):
+        segment_features = input_data['features']
+
+        if isinstance(model, ModelBundle):
+            return {str(component_id): (model.model(component_id).predict(component_features).tolist() if len(component_features) > 0 else [])
+                    for component_id, component_features in zip(input_data['component_ids'], segment_features)}
+
+        lengths = [len(component_features) for component_features in segment_features]
+        non_empty = [component_features for component_features in segment_features if len(component_features) > 0]
+
+        pred = model.predict(pd.concat(non_empty, axis=0)) if non_empty else np.empty(0, dtype=np.int64)
+        splits = np.split(pred, np.cumsum(lengths)[:-1])
+
+        return {str(component_id): component_pred.tolist() for component_id, component_pred in zip(input_data['component_ids'], splits)}
+
+    if isinstance(model, ModelBundle):
+        model = model.model(None)
+
     pred = model.predict(input_data)
     return pred
 
 
+def load_model(model_dir):
+    """Load the model saved in model_dir, the flattened forest written by forest_artifact.export_forest is memory
+    mapped when the model has it (it scores exactly as the IsolationForest), older models are unpickled with joblib"""
+
+    if os.path.exists(os.path.join(model_dir, "forest", "meta.json")):
+        return forest_artifact.ForestArtifact.load(os.path.join(model_dir, "forest"))
+
+    return joblib.load(os.path.join(model_dir, "model.joblib"))
+
+
+class ModelBundle:
+    """The models of every component written by the training job, loaded the first time they are used.
+
+    index.json maps each component id to the directory of its model, model(None) and the components that were
+    not trained return the default model."""
+
+    def __init__(self, model_dir, index):
+
+        self.model_dir = model_dir
+        self.index = index
+        self.models = {}
+
+    def model(self, component_id):
+
+        component_id = str(component_id)
+
+        if component_id not in self.index['components']:
+            if self.index.get('default') not in self.index['components']:
+                raise ValueError('No model for component {} and no default model in {}'.format(component_id, os.path.join(self.model_dir, 'index.json')))
+
+            component_id = self.index['default']
+
+        if component_id not in self.models:
+            self.models[component_id] = load_model(os.path.join(self.model_dir, self.index['components'][component_id]['path']))
+
+        return self.models[component_id]
+
+
 def model_fn(model_dir):
     """Deserialize fitted model
+
+    Models trained per component come as a ModelBundle, single models as the model itself (see load_model).
     """
-    clf = joblib.load(os.path.join(model_dir, "model.joblib"))
-    return clf
+    if os.path.exists(os.path.join(model_dir, "index.json")):
+        with open(os.path.join(model_dir, "index.json")) as index_file:
+            return ModelBundle(model_dir, json.load(index_file))
+
+    return load_model(model_dir)
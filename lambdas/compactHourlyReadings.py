@@ -0,0 +1,249 @@
+import datetime
+import io
+import json
+import os
+import tempfile
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from updateAthenaPartitions import DATABASE_NAME, TABLE_NAME, glue_client, register_partitions, table_storage_descriptor
+
+print('Loading function')
+
+s3 = boto3.client('s3')
+
+# Buckets of the raw readings (one per component, named ...-<component>) compacted by the scheduled runs
+RAW_BUCKETS = [bucket for bucket in os.environ.get('RAW_BUCKETS', '').split(',') if bucket]
+
+# Tables of a component next to the raw TABLE_NAME + component, their location in Glue is where the files are written
+PARQUET_TABLE_SUFFIX = '_parquet'
+ROLLUP_TABLE_SUFFIX = '_rollup'
+PARQUET_FILE_NAME = 'readings.parquet'
+ROLLUP_FILE_NAME = 'rollup.parquet'
+
+READ_CHUNK_SIZE = 1024 * 1024
+# Records converted and written to the Parquet file at a time
+RECORD_BATCH_SIZE = 50000
+ROLLUP_RESOLUTIONS = [('1min', 'min'), ('1hour', 'h')]
+COMPONENT_ID_COLUMN = 'objectId'
+# Fields of the records that are not measures
+NON_MEASURE_COLUMNS = ['timestamp', 'factoryId', 'objectId', 'year', 'month', 'day', 'hour', 'datehour']
+# Arrow type of the Glue column types of the Parquet and rollup tables (solution/db/athena/CreateParquetTable*)
+GLUE_ARROW_TYPES = {'boolean': pa.bool_(), 'double': pa.float64(), 'float': pa.float32(), 'bigint': pa.int64(),
+                    'int': pa.int32(), 'string': pa.string(), 'timestamp': pa.timestamp('ms')}
+
+
+def lambda_handler(event, context):
+    """Compact hours of raw readings into Parquet and rollups.
+
+    Run on a schedule, it compacts the previous hour (or event['hour'], 'YYYY/MM/DD/HH') of event['buckets'] or
+    RAW_BUCKETS, once the hour is complete. S3 events are ignored: compacting an hour again for every object that
+    arrives in it would rewrite its files over and over."""
+
+    if 'Records' in event:
+        print('Ignoring an S3 event of {} records, the hours are compacted by the scheduled runs'.format(len(event['Records'])))
+        return {'hours': []}
+
+    hour = event.get('hour') or (datetime.datetime.utcnow() - datetime.timedelta(hours=1)).strftime('%Y/%m/%d/%H')
+    result = []
+
+    for bucket in sorted(event.get('buckets', RAW_BUCKETS)):
+        compacted = compact_hour(bucket, hour)
+        print('{} {}: {}'.format(bucket, hour, compacted))
+        result.append(compacted)
+
+    return {'hours': result}
+
+
+def read_hour(bucket, hour, batch_size=RECORD_BATCH_SIZE):
+    """Yield the records of all the objects of an hour of a raw bucket in lists of at most batch_size, the objects
+    are streamed line by line so only one batch is in memory"""
+
+    records = []
+    paginator = s3.get_paginator('list_objects_v2')
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=hour + '/'):
+        for s3_object in page.get('Contents', []):
+            body = s3.get_object(Bucket=bucket, Key=s3_object['Key'])['Body']
+
+            for line in body.iter_lines(chunk_size=READ_CHUNK_SIZE):
+                if line.strip():
+                    records.append(json.loads(line))
+
+                if len(records) >= batch_size:
+                    yield records
+                    records = []
+
+    if records:
+        yield records
+
+
+def measure_columns(readings):
+    """The numeric and boolean columns of readings that are not NON_MEASURE_COLUMNS"""
+
+    return [column for column in readings.columns if column not in NON_MEASURE_COLUMNS
+            and (pd.api.types.is_numeric_dtype(readings[column]) or pd.api.types.is_bool_dtype(readings[column]))]
+
+
+def partial_rollup(readings):
+    """min, max, sum and count of every measure per component over 1 minute and 1 hour windows of a batch of
+    readings, one row per (resolution, component, window_start, measure), combined by rollup. Boolean measures are
+    rolled up as 0/1."""
+
+    values = readings.melt(id_vars=[COMPONENT_ID_COLUMN, 'timestamp'], value_vars=measure_columns(readings), var_name='measure')
+    values['value'] = values['value'].astype('float64')
+    rollups = []
+
+    for resolution, frequency in ROLLUP_RESOLUTIONS:
+        values['window_start'] = values['timestamp'].dt.floor(frequency)
+        windows = values.groupby([COMPONENT_ID_COLUMN, 'window_start', 'measure'], sort=False)['value'] \
+            .agg(['min', 'max', 'sum', 'count']).reset_index()
+        windows.insert(0, 'resolution', resolution)
+        rollups.append(windows)
+
+    return pd.concat(rollups, ignore_index=True)
+
+
+def rollup(partial_rollups):
+    """Combine the partial_rollup of every batch of an hour into its min, max, avg and count per (resolution,
+    component, window_start, measure)"""
+
+    keys = ['resolution', COMPONENT_ID_COLUMN, 'window_start', 'measure']
+    windows = pd.concat(partial_rollups, ignore_index=True).groupby(keys, sort=True) \
+        .agg({'min': 'min', 'max': 'max', 'sum': 'sum', 'count': 'sum'}).reset_index()
+    windows.insert(len(keys) + 2, 'avg', windows.pop('sum') / windows['count'])
+
+    return windows
+
+
+def table_schema(database_name, table_name):
+    """The Arrow schema of the columns of a Glue table (the partition keys are not columns). Athena reads millisecond
+    timestamps, so timestamp columns are written in ms."""
+
+    columns = table_storage_descriptor(glue_client, database_name, table_name)['Columns']
+
+    return pa.schema([(column['Name'], GLUE_ARROW_TYPES[column['Type']]) for column in columns])
+
+
+def cast_measures(readings, schema):
+    """Cast in place every measure (a column that is not in NON_MEASURE_COLUMNS) to float64, but the ones the table
+    stores as strings, so that a measure that is None in every reading of a batch is still rolled up and written
+    as a number. Boolean measures become 0/1. Measures that are not in the table keep their dtype."""
+
+    types = {field.name: field.type for field in schema}
+
+    for column in readings.columns:
+        if column in NON_MEASURE_COLUMNS:
+            continue
+
+        column_type = types.get(column.lower())
+
+        if column_type is None and not pd.api.types.is_numeric_dtype(readings[column]) and not pd.api.types.is_bool_dtype(readings[column]):
+            continue
+
+        if column_type != pa.string():
+            readings[column] = readings[column].astype('float64')
+
+
+def to_table(df, schema):
+    """The columns of df as an Arrow table of schema. The columns are matched by name ignoring case (Glue names are
+    lower case), the columns missing from df are null and the columns that are not in the schema are left out."""
+
+    columns = {column.lower(): column for column in df.columns}
+    arrays = []
+
+    for field in schema:
+        if field.name in columns:
+            arrays.append(pa.array(df[columns[field.name]], from_pandas=True).cast(field.type, safe=not pa.types.is_timestamp(field.type)))
+        else:
+            arrays.append(pa.nulls(len(df), field.type))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def partition_location(database_name, table_name, partitions_values):
+    """The bucket and prefix of the partition of a table, at the location register_partitions gives it"""
+
+    location = table_storage_descriptor(glue_client, database_name, table_name)['Location'] + '/'.join(partitions_values) + '/'
+
+    return location[len('s3://'):].split('/', 1)
+
+
+def write_parquet(df, database_name, table_name, partitions_values, file_name):
+    """Write df as a Parquet file with the schema of a table in one of its partitions"""
+
+    bucket, prefix = partition_location(database_name, table_name, partitions_values)
+
+    buffer = io.BytesIO()
+    pq.write_table(to_table(df, table_schema(database_name, table_name)), buffer)
+    s3.put_object(Bucket=bucket, Key=prefix + file_name, Body=buffer.getvalue())
+
+
+def compact_hour(bucket, hour):
+    """Write an hour of raw readings of a bucket as one Parquet file and its rollups as another, and register the
+    hour in the Parquet and rollup tables of the component. Partitions are by arrival hour, as the raw table.
+
+    The readings are written batch by batch with a ParquetWriter to a file in /tmp, and the rollups are combined
+    from the partial rollups of every batch. Both files have the schema of their table in Glue, whatever columns
+    the batches have, see cast_measures and to_table."""
+
+    component = bucket.split('-')[-1]
+    partitions_values = hour.split('/')
+    parquet_table = TABLE_NAME + component + PARQUET_TABLE_SUFFIX
+    rollup_table = TABLE_NAME + component + ROLLUP_TABLE_SUFFIX
+
+    schema = table_schema(DATABASE_NAME, parquet_table)
+    extra_columns = set()
+
+    local_path = os.path.join(tempfile.gettempdir(), '{}-{}-{}'.format(bucket, hour.replace('/', ''), PARQUET_FILE_NAME))
+    writer = None
+    partial_rollups = []
+    records = 0
+
+    try:
+        for batch in read_hour(bucket, hour):
+            readings = pd.DataFrame.from_records(batch)
+            readings['timestamp'] = pd.to_datetime(readings['timestamp'])
+
+            cast_measures(readings, schema)
+
+            partial_rollups.append(partial_rollup(readings))
+            records += len(readings)
+
+            # The partition columns are in the partition values already
+            extra_columns.update(column for column in readings.columns
+                                 if column.lower() not in schema.names and column not in ['year', 'month', 'day', 'hour'])
+
+            if writer is None:
+                writer = pq.ParquetWriter(local_path, schema)
+
+            writer.write_table(to_table(readings, schema))
+
+        if writer is None:
+            return {'bucket': bucket, 'hour': hour, 'records': 0}
+
+        if extra_columns:
+            print('{} {}: columns {} are not in {}, they are not written'.format(bucket, hour, sorted(extra_columns), parquet_table))
+
+        writer.close()
+        writer = None
+
+        parquet_bucket, parquet_prefix = partition_location(DATABASE_NAME, parquet_table, partitions_values)
+        s3.upload_file(local_path, parquet_bucket, parquet_prefix + PARQUET_FILE_NAME)
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+    rollups = rollup(partial_rollups)
+    write_parquet(rollups, DATABASE_NAME, rollup_table, partitions_values, ROLLUP_FILE_NAME)
+
+    created = register_partitions(glue_client, DATABASE_NAME, parquet_table, [partitions_values]) + \
+        register_partitions(glue_client, DATABASE_NAME, rollup_table, [partitions_values])
+
+    return {'bucket': bucket, 'hour': hour, 'records': records, 'rollup_rows': len(rollups), 'partitions_created': created}
@@ -2,35 +2,65 @@ import json
 import base64
 import re
 
+# Date and hour of the "timestamp" field, read straight from the JSON bytes of a record
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp"\s*:\s*"(\d\d\d\d)-(\d\d)-(\d\d)\s(\d\d)')
+PARTITION_FIELDS = b', "year": "%s", "month": "%s", "day": "%s", "hour": "%s", "datehour": "%s/%s/%s/%s"}\n'
+
+
 def lambda_handler(event, context):
-    # TODO implement
-    
+
     output = []
-    
+    failed = 0
+
     for record in event['records']:
         #Kinesis data is base64 encoded so decode here
-        payload=base64.b64decode(record["data"])
-        payload=json.loads(payload)
-        
-        match = re.search('^(\d\d\d\d)-(\d\d)-(\d\d)\s(\d\d).*$', payload['timestamp'])
-        
-        payload['year'] = match.group(1)
-        payload['month'] = match.group(2)
-        payload['day'] = match.group(3)
-        payload['hour'] = match.group(4)
-        payload['datehour'] = payload['year'] + '/' + payload['month'] + '/' + payload['day'] + '/' + payload['hour']
-        
-        payload = json.dumps(payload) + '\n'
-        
-        print("Transformed payload: " + payload)
-        
-        output_record = {
-            'recordId': record['recordId'],
-            'result': 'Ok',
-            'data': base64.b64encode(payload.encode('utf-8'))
-        }
-        output.append(output_record)
-        
-    print('Successfully processed {} records.'.format(len(event['records'])))
-    
+        payload = base64.b64decode(record['data'])
+        transformed = add_partition_keys(payload)
+
+        if transformed is None:
+            failed += 1
+            output.append({'recordId': record['recordId'], 'result': 'ProcessingFailed', 'data': record['data']})
+        else:
+            output.append({'recordId': record['recordId'], 'result': 'Ok', 'data': base64.b64encode(transformed).decode('ascii')})
+
+    print('Processed {} records, {} failed.'.format(len(event['records']), failed))
+
     return {'records': output}
+
+
+def add_partition_keys(payload):
+    """Return the JSON object payload (bytes) with the year, month, day, hour and datehour of its timestamp added
+    as the last fields, followed by a new line. None when the payload has no timestamp or is not a JSON object.
+
+    The fields are spliced in before the closing brace with the separators of json.dumps, the payload is not
+    parsed nor serialized again. The "timestamp" found is the one of the record only when no other object was
+    opened before it, otherwise (e.g. a nested object with its own timestamp first) the payload is parsed."""
+
+    match = TIMESTAMP_PATTERN.search(payload)
+    payload = payload.rstrip()
+
+    if match is None or not payload.endswith(b'}') or b'{' in payload[payload.find(b'{') + 1:match.start()]:
+        return parse_partition_keys(payload)
+
+    year, month, day, hour = match.groups()
+
+    return payload[:-1] + PARTITION_FIELDS % (year, month, day, hour, year, month, day, hour)
+
+
+def parse_partition_keys(payload):
+    """Slow path of add_partition_keys for the payloads the scanner can not read (an escaped timestamp, padding
+    after the object...): parse the JSON and serialize it again with the partition fields."""
+
+    try:
+        record = json.loads(payload)
+        match = re.match(r'^(\d\d\d\d)-(\d\d)-(\d\d)\s(\d\d)', record['timestamp'])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+    if match is None:
+        return None
+
+    record['year'], record['month'], record['day'], record['hour'] = match.groups()
+    record['datehour'] = '/'.join(match.groups())
+
+    return (json.dumps(record) + '\n').encode('utf-8')
@@ -0,0 +1,70 @@
+import argparse
+import base64
+import datetime
+import json
+import random
+import re
+import time
+
+import extractPartitionKeys
+
+
+def legacy_transform(data):
+    """The transformation extractPartitionKeys made before splicing the bytes (without its per record print)"""
+
+    payload = json.loads(base64.b64decode(data))
+
+    match = re.search(r'^(\d\d\d\d)-(\d\d)-(\d\d)\s(\d\d).*$', payload['timestamp'])
+
+    payload['year'] = match.group(1)
+    payload['month'] = match.group(2)
+    payload['day'] = match.group(3)
+    payload['hour'] = match.group(4)
+    payload['datehour'] = payload['year'] + '/' + payload['month'] + '/' + payload['day'] + '/' + payload['hour']
+
+    return base64.b64encode((json.dumps(payload) + '\n').encode('utf-8')).decode('ascii')
+
+
+def synthetic_event(records, seed=0):
+    """A Firehose transformation event with thermafuser readings like the ones the producers send"""
+
+    rng = random.Random(seed)
+    start = datetime.datetime(2018, 7, 11)
+    event_records = []
+
+    for i in range(records):
+        reading = {'timestamp': str(start + datetime.timedelta(minutes=5 * i)), 'thermafuserId': rng.randint(1, 300),
+                   'roomOccupied': rng.random() < 0.5, 'zoneTemperature': rng.uniform(65, 78), 'supplyAir': rng.uniform(50, 60),
+                   'airflowFeedback': rng.uniform(100, 400), 'occupiedCoolingSetpoint': 74.0, 'occupiedHeatingSetpoint': 70.0,
+                   'terminalLoad': rng.uniform(0, 100), 'factoryId': 1, 'objectId': 1}
+        event_records.append({'recordId': str(i), 'data': base64.b64encode(json.dumps(reading).encode('utf-8')).decode('ascii')})
+
+    return {'records': event_records}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=500, help='Records per Firehose batch')
+    parser.add_argument('--batches', type=int, default=20)
+    args = parser.parse_args()
+
+    event = synthetic_event(args.records)
+
+    start = time.perf_counter()
+    for i in range(args.batches):
+        legacy = [legacy_transform(record['data']) for record in event['records']]
+    legacy_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(args.batches):
+        result = extractPartitionKeys.lambda_handler(event, None)
+    spliced_secs = time.perf_counter() - start
+
+    spliced = [record['data'] for record in result['records']]
+    same_objects = all(json.loads(base64.b64decode(a)) == json.loads(base64.b64decode(b)) for a, b in zip(legacy, spliced))
+    same_bytes = legacy == spliced
+
+    total = args.records * args.batches
+    print('legacy: {:.0f} records/s, spliced: {:.0f} records/s ({:.1f}x), same objects: {}, same bytes: {}'.format(
+        total / legacy_secs, total / spliced_secs, legacy_secs / spliced_secs, same_objects, same_bytes))
@@ -0,0 +1 @@
+../anomaly_detection/features.py
\ No newline at end of file
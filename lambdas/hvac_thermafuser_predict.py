@@ -2,15 +2,32 @@ import json
 import boto3
 import traceback
 import sys
+import io
 import os
+import time
 import numpy as np
 import pandas as pd
+
+# The feature pipeline the model is trained with, anomaly_detection/features.py (linked into this directory)
+import features
 #from sagemaker.sklearn.model import SKLearnPredictor
 #from sagemaker.serializers import JSONSerializer
 #from sagemaker.deserializers import NumpyDeserializer
 
 num_anomalies_rule = 50
+# Output column of decode_page for every dimension/column of the thermafuser_readings table
+SCHEMA_COLUMNS = {'Component_Id': 'id', 'Component_Name': 'name', 'Component_Type': 'type', 'measure_name': 'measure', 'time': 'time'}
+RESULT_DTYPES = {'id': 'int64', 'name': 'category', 'type': 'category', 'measure': 'category', 'value': 'float64', 'time': 'datetime64[ns]'}
+# Batched requests to the endpoint, see encode_features and input_fn of the model
+BATCH_CONTENT_TYPE = 'application/x-npz'
+BATCH_MEASURES = ['airflowFeedback', 'supplyAir', 'zoneTemperature']
+# Rolling state of every component between invocations, /tmp survives while the Lambda container stays warm
+SCORER_STATE_PATH = os.environ.get('SCORER_STATE_PATH', '/tmp/thermafuser_scorer_state.json')
 QUERY_1 = 'SELECT * FROM "octank-america-hvac"."thermafuser_readings" WHERE time between ago(10m) and now() ORDER BY time ASC '
+# Readings after the watermark (the oldest last scored reading of the components, in nanoseconds), at most
+# QUERY_LOOKBACK_NS back
+QUERY_INCREMENTAL = 'SELECT * FROM "octank-america-hvac"."thermafuser_readings" WHERE time > from_nanoseconds({}) AND time > ago(1h) ORDER BY time ASC '
+QUERY_LOOKBACK_NS = 3600 * 10 ** 9
 
 def lambda_handler(event, context):
     # TODO implement
@@ -36,43 +53,54 @@ def lambda_handler(event, context):
     #deserializer = NumpyDeserializer()
     #predictor = SKLearnPredictor(endpoint_name=endpoint, sagemaker_session=sagemaker_session, serializer=serializer, deserializer=deserializer)
     
-    #Query timestream for the latest data
+    #Query timestream for the readings after the last scored one (the last 10 minutes on a cold start)
+    scorer_state = load_scorer_state(SCORER_STATE_PATH)
+    reset_stale_components(scorer_state, time.time_ns() - QUERY_LOOKBACK_NS)
+
+    # The oldest position, so no component misses readings, ComponentScorer.update skips the ones it already used
+    watermark = min((component_state['last_time'] for component_state in scorer_state.values()), default=None)
+    query = QUERY_1 if watermark is None else QUERY_INCREMENTAL.format(watermark)
+
     paginator = ts_query_client.get_paginator('query')
-    res_df = run_query(paginator, QUERY_1)
+    res_df = run_query(paginator, query)
     
-    res_df = res_df.rename(columns={0:'id', 1:'name', 2:'type', 3:'measure', 4:'value', 5:'time'})
     print(res_df.head())
-    res_df['time'] = pd.to_datetime(res_df['time'])
     
     #Create dataframes for each component
-    unique_ids = res_df['id'].unique()
+    dfs, components = pivot_components(res_df)
 
-    dfs = {}
-    
-    for identifier in unique_ids:
-        id_df = res_df.loc[res_df['id'] == identifier]
-        #print(id_df.head())
-        componentName = id_df.iloc[0]['name']
-        componentType = id_df.iloc[0]['type']
-        pivoted_df = id_df.pivot(index="time", columns="measure", values="value")
-        pivoted_df = pivoted_df.reset_index()
-        
-        payload = pivoted_df.to_json()
-        
-        dfs[identifier] = pivoted_df
-        
-        #print(pivoted_df.head())
-        #print(pivoted_df.shape)
-        
-        #response = predictor.predict(json_df, initial_args={'ContentType': 'application/json', 'Accept': 'application/json'})
-        
-        response = sagemaker_runtime.invoke_endpoint(EndpointName=ENDPOINT_NAME, ContentType='application/json', Accept='application/json', Body=json.dumps(payload))
-        bresponse = response['Body'].read()
-        predictions = np.array(json.loads(bresponse))
+    #Update the rolling windows of every component with its new readings
+    scorers = {}
+    new_features = {}
+
+    for identifier, pivoted_df in dfs.items():
+        scorers[identifier] = ComponentScorer(scorer_state.get(str(identifier)))
+        new_features[identifier] = scorers[identifier].update(pivoted_df)
+
+    new_features = {identifier: component_features for identifier, component_features in new_features.items() if len(component_features[0]) > 0}
+
+    if not new_features:
+        save_scorer_state(SCORER_STATE_PATH, scorer_state, scorers)
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps('No readings to score')
+        }
+
+    #response = predictor.predict(json_df, initial_args={'ContentType': 'application/json', 'Accept': 'application/json'})
+
+    #Score the new points of every component with a single request, the predictions come back keyed by component id
+    response = sagemaker_runtime.invoke_endpoint(EndpointName=ENDPOINT_NAME, ContentType=BATCH_CONTENT_TYPE, Accept='application/json', Body=encode_features(new_features))
+    bresponse = response['Body'].read()
+    batch_predictions = json.loads(bresponse)
+
+    for identifier, (positions, component_features) in new_features.items():
+        pivoted_df = dfs[identifier]
+        componentName, componentType = components[identifier]
+        predictions = np.array(batch_predictions[str(identifier)])
         anomalies_zero = predictions + 1
         
-        predictions_start_index = pivoted_df.shape[0] - predictions.shape[0]
-        predicted_df = pivoted_df[predictions_start_index:].copy()
+        predicted_df = pivoted_df.iloc[positions].copy()
         predicted_df['anomaly'] = predictions
         
         #print(predicted_df.head())
@@ -90,12 +118,127 @@ def lambda_handler(event, context):
         #print(predictions)
         #print(predictions.shape)
     
+    #The windows are saved once the new points are scored, a failed run scores them again
+    save_scorer_state(SCORER_STATE_PATH, scorer_state, scorers)
+
     return {
         'statusCode': 200,
         'body': json.dumps('Hello from Lambda!')
     }
     
 
+def pivot_components(res_df):
+    """Pivot the long Timestream result into one wide panel (a column per measure) with a single unstack.
+
+    The panel is ordered by id and time, the frame of each component is a row slice of it (no copy) with the time
+    and measure columns. Return the frames and the (name, type) of the components, both keyed by id."""
+
+    wide = res_df.set_index(['id', 'time', 'measure'])['value'].unstack('measure')
+    wide.columns = wide.columns.astype(str)
+    panel = wide.reset_index()
+
+    ids = panel['id'].to_numpy()
+    unique_ids = np.unique(ids)
+    starts = np.searchsorted(ids, unique_ids, side='left')
+    ends = np.searchsorted(ids, unique_ids, side='right')
+
+    first_rows = res_df.drop_duplicates('id').set_index('id')
+    dfs = {identifier: panel.iloc[start:end, 1:] for identifier, start, end in zip(unique_ids.tolist(), starts, ends)}
+    components = {identifier: (first_rows.at[identifier, 'name'], first_rows.at[identifier, 'type']) for identifier in dfs}
+
+    return dfs, components
+
+
+class ComponentScorer:
+    """Rolling window state of one component, computes the model features of each new reading incrementally
+    with features.StreamingFeatures, so they are the ones the model was trained with.
+
+    The state is the time of the last reading used (nanoseconds) and the StreamingFeatures state, see to_state."""
+
+    def __init__(self, state=None):
+
+        state = state or {}
+        self.last_time = state.get('last_time')
+        self.streaming = features.StreamingFeatures.from_state(state['features']) if 'features' in state else features.StreamingFeatures()
+
+    def update(self, pivoted_df):
+        """Push the readings of pivoted_df newer than the last one used, return the positions in pivoted_df of
+        the readings that have complete features and those features (rows x 7, features.FEATURE_COLUMNS)"""
+
+        times = pivoted_df['time'].to_numpy(dtype='datetime64[ns]')
+        measures = [pivoted_df[measure].to_numpy(dtype=np.float64) if measure in pivoted_df else np.full(len(times), np.nan)
+                    for measure in BATCH_MEASURES]
+
+        positions = []
+        rows = []
+
+        for position in range(len(times)):
+            time_ns = int(times[position].view(np.int64))
+
+            if self.last_time is not None and time_ns <= self.last_time:
+                continue
+
+            row = self.streaming.push(times[position], *[values[position] for values in measures])
+            self.last_time = time_ns
+
+            if row is not None:
+                positions.append(position)
+                rows.append(row)
+
+        return positions, np.array(rows, dtype=np.float64).reshape(-1, len(features.FEATURE_COLUMNS))
+
+    def to_state(self):
+
+        return {'features': self.streaming.to_state(), 'last_time': self.last_time}
+
+
+def load_scorer_state(path):
+
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def reset_stale_components(scorer_state, oldest_time):
+    """Forget the state of the components whose last reading is older than oldest_time (nanoseconds): the query
+    does not go back that far, so their windows would join readings from both sides of a gap"""
+
+    for identifier in [identifier for identifier, component_state in scorer_state.items()
+                       if component_state.get('last_time') is None or component_state['last_time'] < oldest_time]:
+        print('Resetting the rolling windows of component {}'.format(identifier))
+        del scorer_state[identifier]
+
+
+def save_scorer_state(path, scorer_state, scorers):
+    """Write the state of every component, the components that had no new readings keep their previous state"""
+
+    for identifier, scorer in scorers.items():
+        if scorer.last_time is not None:
+            scorer_state[str(identifier)] = scorer.to_state()
+
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(scorer_state, state_file)
+
+    os.replace(path + '.tmp', path)
+
+
+def encode_features(features):
+    """Encode the precomputed features of every component in the .npz layout input_fn of the model expects:
+    component_ids, offsets (rows of component i are offsets[i]:offsets[i + 1]) and features"""
+
+    identifiers = list(features)
+    lengths = [len(features[identifier][0]) for identifier in identifiers]
+
+    buffer = io.BytesIO()
+    np.savez(buffer, component_ids=np.array(identifiers, dtype=np.int64),
+             offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+             features=np.concatenate([features[identifier][1] for identifier in identifiers]))
+
+    return buffer.getvalue()
+
+
 def anomalies_to_s3(kinesis_client, stream_name, df_anomalies, idFactory, idComponent, componentName, componentType):
     
     df_anomalies = df_anomalies.rename(columns={'time':'timestamp'})
@@ -125,66 +268,93 @@ def anomalies_to_s3(kinesis_client, stream_name, df_anomalies, idFactory, idComp
 
 
 def run_query(paginator, query_string):
-    
-        results = None
-    
-        try:
-            page_iterator = paginator.paginate(QueryString=query_string)
-            for page in page_iterator:
-                results = parse_query_result(page)
-                
-                res_df = pd.DataFrame(results)
-                
-                return res_df
-        except Exception as err:
-            print("Exception while running query:", err)
-            traceback.print_exc(file=sys.stderr)    
-    
-    
-def parse_query_result(query_result):
-    query_status = query_result["QueryStatus"]
-    column_info = query_result['ColumnInfo']
-    
-    results = []
-    
-    #print(query_status)
-    
-    #print("Metadata: %s" % column_info)
-    #print("Data: ")
-    for row in query_result['Rows']:
-        results.append(parse_row(column_info, row))
-        
-    return results
-        
+    """Run the query and decode every page of its result into a typed DataFrame, see decode_page"""
 
-def parse_row(column_info, row):
-    data = row['Data']
-    row_output = []
-    convert_data = {'BOOLEAN':bool, 'BIGINT':int, 'VARCHAR':str, 'DOUBLE':float}
-    
-    idComponent = None
-    measure_name = ''
-    measure_value = 0
-    measure_time = None
-    
-    for j in range(len(data)):
-        info = column_info[j]
-        datum = data[j]
-        
-        if datum.get('NullValue') != True:
-            
-            if info['Name'] == 'Component_Id':
-                idComponent = int(datum['ScalarValue'])
-            elif info['Name'] == 'Component_Type':
-                componentType = datum['ScalarValue']
-            elif info['Name'] == 'Component_Name':
-                componentName = datum['ScalarValue']
-            elif 'measure_value' in info['Name']:
-                measure_value = convert_data[info['Type']['ScalarType']](datum['ScalarValue'])
-            elif info['Name'] == 'measure_name':
-                measure_name = str(datum['ScalarValue'])
-            elif info['Name'] == 'time':
-                measure_time = str(datum['ScalarValue'])
-                
-    return (idComponent, componentName, componentType, measure_name, measure_value, measure_time)
+    frames = []
+    schema = None
+    column_info = None
+    pages, rows = 0, 0
+    decode_secs = 0.0
+
+    try:
+        page_iterator = paginator.paginate(QueryString=query_string)
+
+        for page in page_iterator:
+            start = time.perf_counter()
+
+            # The schema is the same for every page of a query, resolve the column indices only when it changes
+            if page['ColumnInfo'] != column_info:
+                column_info = page['ColumnInfo']
+                schema = resolve_schema(column_info)
+
+            if page['Rows']:
+                frames.append(decode_page(page['Rows'], schema))
+
+            pages += 1
+            rows += len(page['Rows'])
+            decode_secs += time.perf_counter() - start
+
+    except Exception as err:
+        print("Exception while running query:", err)
+        traceback.print_exc(file=sys.stderr)
+        return None
+
+    print('Query decoded: {} pages, {} rows in {:.3f}s'.format(pages, rows, decode_secs))
+
+    if not frames:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in RESULT_DTYPES.items()})
+
+    res_df = pd.concat(frames, ignore_index=True)
+
+    # The categories of every page may differ, build them once for the whole result
+    for column in ('name', 'type', 'measure'):
+        res_df[column] = res_df[column].astype('category')
+
+    return res_df
+
+
+def resolve_schema(column_info):
+    """Return the index of the id, name, type, measure name and time columns of the rows of a result, and the
+    (index, scalar type) of its measure_value::<type> columns"""
+
+    indices = {}
+    value_columns = []
+
+    for j, info in enumerate(column_info):
+        if 'measure_value' in info['Name']:
+            value_columns.append((j, info['Type']['ScalarType']))
+        elif info['Name'] in SCHEMA_COLUMNS:
+            indices[SCHEMA_COLUMNS[info['Name']]] = j
+
+    return indices, value_columns
+
+
+def decode_page(rows, schema):
+    """Decode the rows of a page into a DataFrame with the columns id, name, type, measure, value and time.
+
+    Each column is read with a single pass over the rows and converted by numpy/pandas at once. value is a
+    float64 whatever the measure type (booleans become 1.0/0.0), NULL values become NaN."""
+
+    indices, value_columns = schema
+    data = [row['Data'] for row in rows]
+
+    def scalars(j):
+        return [cells[j].get('ScalarValue') for cells in data]
+
+    values = np.full(len(data), np.nan)
+
+    for j, scalar_type in value_columns:
+        column = np.array(scalars(j), dtype=object)
+        present = column != None
+
+        if scalar_type == 'BOOLEAN':
+            values[present] = column[present] == 'true'
+        elif scalar_type in ('DOUBLE', 'BIGINT'):
+            values[present] = column[present].astype(np.float64)
 
+    return pd.DataFrame({'id': np.array(scalars(indices['id'])).astype(np.int64),
+                         'name': scalars(indices['name']),
+                         'type': scalars(indices['type']),
+                         'measure': scalars(indices['measure']),
+                         'value': values,
+                         'time': pd.to_datetime(scalars(indices['time']), format='%Y-%m-%d %H:%M:%S.%f')})
@@ -1,4 +1,5 @@
 import json
+import time
 import urllib.parse
 import boto3
 import copy
@@ -7,71 +8,116 @@ print('Loading function')
 
 s3 = boto3.client('s3')
 athena_client = boto3.client('athena')
+glue_client = boto3.client('glue')
+
+DATABASE_NAME = 'hvac'
+TABLE_NAME = 'readings_octank_america_hvac_'
+
+# batch_create_partition takes at most 100 partitions per call
+BATCH_CREATE_PARTITION_MAX = 100
+STORAGE_DESCRIPTOR_TTL_SECS = 900
+
+# Kept while the Lambda container stays warm: the partitions already registered, keyed by (database, table,
+# values), and the storage descriptor of every table with the time it was read
+known_partitions = set()
+storage_descriptors = {}
 
 
 def lambda_handler(event, context):
     #print("Received event: " + json.dumps(event, indent=2))
-    
-    DATABASE_NAME = 'hvac'
-    TABLE_NAME = 'readings_octank_america_hvac_'
-    
-
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    try:
-        print("bucket--->" + bucket)
-        print("key---->" + key)
-        
+
+    # Group the partitions of every object of the event by table
+    partitions_by_table = {}
+
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+
         component = bucket.split('-')[-1]
-        
-        print("component---->" + component)
-        
+
         # Assuming object key is folder_name/YYYY/MM/DD/HH/sample.json
         partitions_values = key.split('/')[:-1] # Remove the filename at the end
-        print(partitions_values) # Output: [‘YYYY’, ‘MM', ‘DD’, ‘HH']
-        
-        # Initialise the Glue client using Boto 3
-        glue_client = boto3.client('glue')
-        
-        try:
-            # Check if the partition already exists. If yes, skip adding it again
-            get_partition_response = glue_client.get_partition(
-            DatabaseName=DATABASE_NAME,
-            TableName=TABLE_NAME+component,
-            PartitionValues=partitions_values
-            )
-            print('Glue partition already exists.')
-
-        except Exception as e:
-            # Check if the exception is EntityNotFoundException. If yes, go ahead and create parition
-            if type(e).__name__ == 'EntityNotFoundException':
-                print('Retrieve Table Details:')
-                get_table_response = glue_client.get_table(
-                DatabaseName=DATABASE_NAME,
-                Name=TABLE_NAME+component
-                )
-    
-                # Extract the existing storage descriptor and Create custom storage descriptor with new partition location
-                storage_descriptor = get_table_response['Table']['StorageDescriptor']
-                custom_storage_descriptor = copy.deepcopy(storage_descriptor)
-                custom_storage_descriptor['Location'] = storage_descriptor['Location'] + "/".join(partitions_values) + '/'
-    
-                # Create new Glue partition in the Glue Data Catalog
-                create_partition_response = glue_client.create_partition(
-                DatabaseName=DATABASE_NAME,
-                TableName=TABLE_NAME+component,
-                PartitionInput={
-                    'Values': partitions_values,
-                    'StorageDescriptor': custom_storage_descriptor
-                    }
-                )
-                print('Glue partition created successfully.') 
-            else:
-                # Handle exception as per your business requirements
-                print(e)   
-        
+        partitions_by_table.setdefault(TABLE_NAME + component, []).append(partitions_values)
+
+    try:
+        for table_name, partitions_values in partitions_by_table.items():
+            created = register_partitions(glue_client, DATABASE_NAME, table_name, partitions_values)
+            print('{}: {} records, {} partitions created'.format(table_name, len(partitions_values), created))
+
     except Exception as e:
         print(e)
-        print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
+        print('Error registering the partitions of {} records. Make sure the tables exist and the bucket is in the same region as this function.'.format(len(event['Records'])))
         raise e
+
+
+def table_storage_descriptor(glue_client, database_name, table_name):
+    """Return the storage descriptor of a table, read from Glue at most every STORAGE_DESCRIPTOR_TTL_SECS"""
+
+    cached = storage_descriptors.get((database_name, table_name))
+
+    if cached is None or time.monotonic() - cached[1] > STORAGE_DESCRIPTOR_TTL_SECS:
+        print('Retrieve Table Details: ' + table_name)
+        get_table_response = glue_client.get_table(DatabaseName=database_name, Name=table_name)
+        cached = (get_table_response['Table']['StorageDescriptor'], time.monotonic())
+        storage_descriptors[(database_name, table_name)] = cached
+
+    return cached[0]
+
+
+def register_partitions(glue_client, database_name, table_name, partitions_values):
+    """Register the partitions (lists of values, e.g. ['2021', '03', '10', '12']) of a table in the Glue Data Catalog.
+
+    The partitions already registered by this container are skipped and the rest are created with
+    batch_create_partition, a partition that already exists counts as registered. The location of a partition is
+    the location of the table followed by its values. Return the number of partitions created, raise an exception
+    when Glue rejected some of them (they are tried again on the next call)."""
+
+    new_partitions = []
+    seen = set()
+
+    for values in partitions_values:
+        if (database_name, table_name, tuple(values)) not in known_partitions and tuple(values) not in seen:
+            seen.add(tuple(values))
+            new_partitions.append(list(values))
+
+    if not new_partitions:
+        return 0
+
+    storage_descriptor = table_storage_descriptor(glue_client, database_name, table_name)
+    created = 0
+    failed = []
+
+    for start in range(0, len(new_partitions), BATCH_CREATE_PARTITION_MAX):
+        chunk = new_partitions[start:start + BATCH_CREATE_PARTITION_MAX]
+        partition_inputs = []
+
+        for values in chunk:
+            # Create custom storage descriptor with new partition location
+            custom_storage_descriptor = copy.deepcopy(storage_descriptor)
+            custom_storage_descriptor['Location'] = storage_descriptor['Location'] + "/".join(values) + '/'
+            partition_inputs.append({'Values': values, 'StorageDescriptor': custom_storage_descriptor})
+
+        response = glue_client.batch_create_partition(DatabaseName=database_name, TableName=table_name,
+                                                      PartitionInputList=partition_inputs)
+
+        rejected = set()
+
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] == 'AlreadyExistsException':
+                created -= 1
+            else:
+                print('Glue partition {} not created: {}'.format(error['PartitionValues'], error['ErrorDetail']))
+                rejected.add(tuple(error['PartitionValues']))
+
+        created += len(chunk) - len(rejected)
+
+        for values in chunk:
+            if tuple(values) in rejected:
+                failed.append(values)
+            else:
+                known_partitions.add((database_name, table_name, tuple(values)))
+
+    if failed:
+        raise RuntimeError('{} partitions of {} could not be created'.format(len(failed), table_name))
+
+    return created
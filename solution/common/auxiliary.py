@@ -1,26 +1,204 @@
+import atexit
+import threading
+import time
+
 import sqlalchemy
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 
 
-def connect_to_db(host, dbname, username=None, pasw=None):
-    """Exceptions are handled at the use business layer"""
+# Process wide registries keyed by the database string, see get_engine
+_engines = {}
+_session_factories = {}
+_scoped_sessions = {}
+_async_engines = {}
+_registry_lock = threading.Lock()
 
-    sqlsession, sqlengine = None, None
 
-    #driver = "?driver=ODBC+Driver+17+for+SQL+Server"
+class PoolCheckoutMetrics:
+    """Accumulates how long the checkouts of a connection pool waited for a connection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self):
+        with self._lock:
+            return {'checkouts': self.checkouts, 'wait_total': self.wait_total, 'wait_max': self.wait_max,
+                    'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0}
+
+
+class TimedPoolMixin:
+    """Reports the time a pool spent waiting for a connection to its PoolCheckoutMetrics"""
+
+    checkout_metrics = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        finally:
+            if self.checkout_metrics is not None:
+                self.checkout_metrics.record(time.perf_counter() - start)
+
+    def recreate(self):
+        # dispose() builds a new pool of the same class, keep accumulating on the same metrics
+        pool = super().recreate()
+        pool.checkout_metrics = self.checkout_metrics
+        return pool
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    """QueuePool with checkout wait metrics, used by get_engine"""
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool with checkout wait metrics, used by get_async_engine"""
+
+
+def get_database_string(host, dbname, username=None, pasw=None):
 
     if username == None:
         databaseString = "mysql+pymysql://" + host + "/" + dbname
     else:
         databaseString = "mysql+pymysql://" + username + ":" + pasw + "@" + host + "/" + dbname
 
-    sqlengine = sqlalchemy.create_engine(databaseString)
-    SQLSession = sessionmaker(bind=sqlengine)
+    return databaseString
+
+
+def get_engine(host, dbname, username=None, pasw=None, pool_size=10, max_overflow=20, pool_pre_ping=True,
+               pool_recycle=3600, pool_timeout=30):
+    """Return the engine of the process for this database, it is created on the first call.
+
+    Every caller shares the engine and its connection pool, so the pool options of the first call are the
+    ones used. pool_recycle should stay below the wait_timeout of the MySQL server."""
+
+    databaseString = get_database_string(host, dbname, username, pasw)
+
+    with _registry_lock:
+        sqlengine = _engines.get(databaseString)
+
+        if sqlengine is None:
+            sqlengine = sqlalchemy.create_engine(databaseString, poolclass=TimedQueuePool, pool_size=pool_size,
+                                                 max_overflow=max_overflow, pool_pre_ping=pool_pre_ping,
+                                                 pool_recycle=pool_recycle, pool_timeout=pool_timeout)
+            sqlengine.pool.checkout_metrics = PoolCheckoutMetrics()
+
+            _engines[databaseString] = sqlengine
+            _session_factories[databaseString] = sessionmaker(bind=sqlengine)
+
+    return sqlengine
+
+
+def get_async_engine(host, dbname, username=None, pasw=None, pool_size=10, max_overflow=20, pool_pre_ping=True,
+                     pool_recycle=3600):
+    """Return the asyncio engine (aiomysql driver) of the process for this database, see get_engine.
+
+    The engines are disposed by dispose_async_engines, which has to be awaited before the event loop closes."""
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    databaseString = get_database_string(host, dbname, username, pasw).replace("mysql+pymysql://", "mysql+aiomysql://", 1)
+
+    with _registry_lock:
+        sqlengine = _async_engines.get(databaseString)
+
+        if sqlengine is None:
+            sqlengine = create_async_engine(databaseString, poolclass=TimedAsyncAdaptedQueuePool, pool_size=pool_size,
+                                            max_overflow=max_overflow, pool_pre_ping=pool_pre_ping,
+                                            pool_recycle=pool_recycle)
+            sqlengine.sync_engine.pool.checkout_metrics = PoolCheckoutMetrics()
+            _async_engines[databaseString] = sqlengine
+
+    return sqlengine
+
+
+async def dispose_async_engines():
+
+    with _registry_lock:
+        engines = list(_async_engines.values())
+        _async_engines.clear()
+
+    for sqlengine in engines:
+        await sqlengine.dispose()
+
+
+def get_scoped_session(host, dbname, username=None, pasw=None, **engine_options):
+    """Return a thread local session registry bound to the shared engine of this database.
+
+    Calling the registry returns the session of the current thread, call remove() on it when the thread is done."""
+
+    databaseString = get_database_string(host, dbname, username, pasw)
+    sqlengine = get_engine(host, dbname, username, pasw, **engine_options)
+
+    with _registry_lock:
+        sqlsessions = _scoped_sessions.get(databaseString)
+
+        if sqlsessions is None:
+            sqlsessions = scoped_session(sessionmaker(bind=sqlengine))
+            _scoped_sessions[databaseString] = sqlsessions
+
+    return sqlsessions
+
+
+def get_pool_metrics():
+    """Return the checkout wait metrics and the status of every pool, keyed by host/database (with an async/
+    prefix for the asyncio engines)"""
+
+    with _registry_lock:
+        engines = [('', sqlengine) for sqlengine in _engines.values()] + \
+            [('async/', sqlengine.sync_engine) for sqlengine in _async_engines.values()]
+
+    metrics = {}
+
+    for prefix, sqlengine in engines:
+        pool_metrics = sqlengine.pool.checkout_metrics.snapshot()
+        pool_metrics['status'] = sqlengine.pool.status()
+        metrics[prefix + str(sqlengine.url.host) + '/' + str(sqlengine.url.database)] = pool_metrics
+
+    return metrics
+
+
+@atexit.register
+def dispose_engines():
+    """Close the pooled connections of every engine"""
+
+    with _registry_lock:
+        for sqlsessions in _scoped_sessions.values():
+            sqlsessions.remove()
+
+        for sqlengine in _engines.values():
+            sqlengine.dispose()
+
+        _engines.clear()
+        _session_factories.clear()
+        _scoped_sessions.clear()
+
+
+def connect_to_db(host, dbname, username=None, pasw=None):
+    """Exceptions are handled at the use business layer"""
+
+    sqlsession, sqlengine = None, None
+
+    #driver = "?driver=ODBC+Driver+17+for+SQL+Server"
+
+    # The engine (and its connection pool) is shared by every call for the same database
+    sqlengine = get_engine(host, dbname, username, pasw)
+    SQLSession = _session_factories[get_database_string(host, dbname, username, pasw)]
     sqlsession = SQLSession()
 
     # See if the connection is good
     connection = sqlsession.connection()
     connection = None
 
-    return sqlsession, sqlengine
\ No newline at end of file
+    return sqlsession, sqlengine
@@ -0,0 +1,311 @@
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+import traceback
+
+
+class CheckpointStore:
+    """Last processed sequence number of every shard, kept in a local SQLite database so a consumer resumes where
+    it stopped. A shard read to its end (closed by a reshard) is stored as SHARD_END. It is thread safe."""
+
+    SHARD_END = 'SHARD_END'
+
+    def __init__(self, path='kinesis_checkpoints.db'):
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (stream_name TEXT, shard_id TEXT, '
+                                     'sequence_number TEXT, updated REAL, PRIMARY KEY (stream_name, shard_id))')
+
+    def get(self, stream_name, shard_id):
+
+        with self._lock:
+            row = self._connection.execute('SELECT sequence_number FROM checkpoints WHERE stream_name = ? AND shard_id = ?',
+                                           (stream_name, shard_id)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set(self, stream_name, shard_id, sequence_number):
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                                     (stream_name, shard_id, sequence_number, time.time()))
+
+    def close(self):
+
+        with self._lock:
+            self._connection.close()
+
+
+class ShardReader(threading.Thread):
+    """Polls one shard with get_records and hands every non empty batch to process(shard_id, records).
+
+    The checkpoint is written after process returns, so records are delivered at least once. When process raises,
+    the error is logged and the same batch is processed again after max_interval_secs, without checkpointing;
+    get_shard_iterator is retried the same way. The wait between
+    calls adapts to MillisBehindLatest: while the shard is behind it is polled again after min_interval_secs
+    (GetRecords allows 5 calls per second per shard), when it is caught up the wait doubles from
+    poll_interval_secs up to max_interval_secs while no records arrive. Throttled calls back off exponentially.
+    The lag and counters of the shard are kept in self.metrics."""
+
+    def __init__(self, client, stream_name, shard_id, checkpoints, process, stop_event, initial_position='LATEST',
+                 limit=10000, min_interval_secs=0.2, poll_interval_secs=1.0, max_interval_secs=5.0):
+
+        super().__init__(name='shard-' + shard_id, daemon=True)
+
+        self.client = client
+        self.stream_name = stream_name
+        self.shard_id = shard_id
+        self.checkpoints = checkpoints
+        self.process = process
+        self.stop_event = stop_event
+        self.initial_position = initial_position
+        self.limit = limit
+        self.min_interval_secs = min_interval_secs
+        self.poll_interval_secs = poll_interval_secs
+        self.max_interval_secs = max_interval_secs
+        self.logger = logging.getLogger(__name__)
+
+        self.finished = False
+        # When the first LATEST iterator of the shard was asked for, see shard_iterator
+        self.latest_timestamp = None
+        self.metrics = {'millis_behind_latest': None, 'records': 0, 'batches': 0, 'calls': 0, 'throttled': 0,
+                        'errors': 0, 'last_sequence_number': None, 'last_poll': None}
+
+    def shard_iterator(self):
+        """An iterator after the checkpoint of the shard, or at initial_position when it has none. A LATEST iterator
+        asked for again (it expired before any record was checkpointed) starts AT_TIMESTAMP of the first one, so the
+        records that arrived in between are not skipped."""
+
+        sequence_number = self.checkpoints.get(self.stream_name, self.shard_id)
+
+        if sequence_number is not None:
+            return self.client.get_shard_iterator(StreamName=self.stream_name, ShardId=self.shard_id,
+                                                  ShardIteratorType='AFTER_SEQUENCE_NUMBER',
+                                                  StartingSequenceNumber=sequence_number)['ShardIterator']
+
+        if self.initial_position == 'LATEST' and self.latest_timestamp is not None:
+            return self.client.get_shard_iterator(StreamName=self.stream_name, ShardId=self.shard_id,
+                                                  ShardIteratorType='AT_TIMESTAMP', Timestamp=self.latest_timestamp)['ShardIterator']
+
+        requested = datetime.datetime.now(datetime.timezone.utc)
+        shard_iterator = self.client.get_shard_iterator(StreamName=self.stream_name, ShardId=self.shard_id,
+                                                        ShardIteratorType=self.initial_position)['ShardIterator']
+
+        if self.initial_position == 'LATEST':
+            self.latest_timestamp = requested
+
+        return shard_iterator
+
+    def retry(self, action, description):
+        """Call action until it succeeds, logging every failure and waiting max_interval_secs between attempts.
+        Return (True, result), or (False, None) when the reader is stopped before it succeeds."""
+
+        while not self.stop_event.is_set():
+            try:
+                return True, action()
+
+            except Exception:
+                self.metrics['errors'] += 1
+                self.logger.error('{} on {} failed: {}'.format(description, self.shard_id, traceback.format_exc()))
+                self.stop_event.wait(self.max_interval_secs)
+
+        return False, None
+
+    def run(self):
+
+        if self.checkpoints.get(self.stream_name, self.shard_id) == CheckpointStore.SHARD_END:
+            self.finished = True
+            return
+
+        ok, shard_iterator = self.retry(self.shard_iterator, 'get_shard_iterator')
+
+        if not ok:
+            return
+
+        delay = self.poll_interval_secs
+        throttle_delay = self.min_interval_secs
+
+        while shard_iterator is not None and not self.stop_event.is_set():
+
+            try:
+                out = self.client.get_records(ShardIterator=shard_iterator, Limit=self.limit)
+                throttle_delay = self.min_interval_secs
+
+            except self.client.exceptions.ProvisionedThroughputExceededException:
+                self.metrics['throttled'] += 1
+                self.stop_event.wait(throttle_delay)
+                throttle_delay = min(throttle_delay * 2, self.max_interval_secs)
+                continue
+
+            except self.client.exceptions.ExpiredIteratorException:
+                ok, shard_iterator = self.retry(self.shard_iterator, 'get_shard_iterator')
+
+                if not ok:
+                    return
+
+                continue
+
+            except Exception:
+                self.metrics['errors'] += 1
+                self.logger.error('get_records on {} failed: {}'.format(self.shard_id, traceback.format_exc()))
+                self.stop_event.wait(self.max_interval_secs)
+                continue
+
+            records = out['Records']
+            shard_iterator = out.get('NextShardIterator')
+
+            self.metrics['calls'] += 1
+            self.metrics['millis_behind_latest'] = out.get('MillisBehindLatest')
+            self.metrics['last_poll'] = time.time()
+
+            if records:
+                # The batch is not checkpointed until process succeeds, a stopped reader resumes from the checkpoint
+                ok, _ = self.retry(lambda: self.process(self.shard_id, records), 'process')
+
+                if not ok:
+                    return
+
+                self.metrics['records'] += len(records)
+                self.metrics['batches'] += 1
+                self.metrics['last_sequence_number'] = records[-1]['SequenceNumber']
+                self.checkpoints.set(self.stream_name, self.shard_id, records[-1]['SequenceNumber'])
+
+            if out.get('MillisBehindLatest', 0) > 0 and records:
+                delay = self.min_interval_secs
+            elif records:
+                delay = self.poll_interval_secs
+            else:
+                delay = min(max(delay, self.poll_interval_secs) * 2, self.max_interval_secs)
+
+            self.stop_event.wait(delay)
+
+        if shard_iterator is None:
+            # The shard was closed by a reshard and all its records were processed
+            self.checkpoints.set(self.stream_name, self.shard_id, CheckpointStore.SHARD_END)
+            self.finished = True
+
+
+class KinesisConsumer:
+    """Reads every shard of a Kinesis data stream, one ShardReader thread per shard.
+
+    The shards are listed again every shard_refresh_secs, as soon as a reader finishes its shard, and when a
+    reader died before finishing it, which is then restarted from its checkpoint. A shard
+    created by a reshard is started once its parents are finished (or expired), from its first record, so the
+    records of a key stay in order. See ShardReader for the polling and checkpointing, and lag_metrics() for the
+    per shard lag."""
+
+    def __init__(self, client, stream_name, process, checkpoints, initial_position='LATEST', shard_refresh_secs=60.0,
+                 **reader_options):
+
+        self.client = client
+        self.stream_name = stream_name
+        self.process = process
+        self.checkpoints = checkpoints
+        self.initial_position = initial_position
+        self.shard_refresh_secs = shard_refresh_secs
+        self.reader_options = reader_options
+        self.logger = logging.getLogger(__name__)
+
+        self.readers = {}
+        self.stop_event = threading.Event()
+
+    def list_shards(self):
+
+        shards = []
+        kwargs = {'StreamName': self.stream_name}
+
+        while True:
+            out = self.client.list_shards(**kwargs)
+            shards.extend(out['Shards'])
+
+            if 'NextToken' not in out:
+                return shards
+
+            kwargs = {'NextToken': out['NextToken']}
+
+    def refresh_shards(self):
+        """Start a reader for every shard that has none, or whose reader died before finishing the shard, and whose
+        parents are done"""
+
+        shards = self.list_shards()
+        listed = {shard['ShardId'] for shard in shards}
+
+        for shard in shards:
+            shard_id = shard['ShardId']
+
+            reader = self.readers.get(shard_id)
+
+            if reader is not None:
+                if reader.finished or reader.is_alive():
+                    continue
+
+                self.logger.warning('Reader of {} stopped before the end of the shard, restarting it'.format(shard_id))
+
+            parents = [shard.get(parent) for parent in ['ParentShardId', 'AdjacentParentShardId'] if shard.get(parent)]
+
+            if any(not self.parent_finished(parent) for parent in parents if parent in listed):
+                continue
+
+            # A child is read from its first record even when its parents expired, the records written to it after
+            # the reshard were never in a parent
+            initial_position = 'TRIM_HORIZON' if parents else self.initial_position
+            reader = ShardReader(self.client, self.stream_name, shard_id, self.checkpoints, self.process, self.stop_event,
+                                 initial_position, **self.reader_options)
+
+            if shard_id in self.readers:
+                # A restarted reader without checkpoint resumes where the reader it replaces started
+                reader.latest_timestamp = self.readers[shard_id].latest_timestamp
+
+            self.readers[shard_id] = reader
+            reader.start()
+
+            self.logger.info('Reading {} of {} from {}'.format(shard_id, self.stream_name, initial_position))
+
+    def parent_finished(self, shard_id):
+
+        reader = self.readers.get(shard_id)
+
+        if reader is not None:
+            return reader.finished
+
+        return self.checkpoints.get(self.stream_name, shard_id) == CheckpointStore.SHARD_END
+
+    def lag_metrics(self):
+        """{shard id: metrics of its reader}, MillisBehindLatest is the lag of the shard behind its newest record"""
+
+        return {shard_id: dict(reader.metrics, finished=reader.finished) for shard_id, reader in self.readers.items()}
+
+    def run(self, report_secs=None, report=None):
+        """Read until stop() is called, calling report(lag_metrics()) every report_secs"""
+
+        last_refresh = None
+        last_report = time.monotonic()
+        finished = 0
+
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            now_finished = sum(reader.finished for reader in self.readers.values())
+            dead = any(not reader.finished and not reader.is_alive() for reader in self.readers.values())
+
+            if last_refresh is None or now - last_refresh >= self.shard_refresh_secs or now_finished != finished or dead:
+                self.refresh_shards()
+                last_refresh = now
+                finished = now_finished
+
+            if report_secs is not None and report is not None and now - last_report >= report_secs:
+                report(self.lag_metrics())
+                last_report = now
+
+            self.stop_event.wait(1.0)
+
+    def stop(self):
+
+        self.stop_event.set()
+
+        for reader in self.readers.values():
+            reader.join()
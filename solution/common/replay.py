@@ -0,0 +1,396 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import class_mapper, sessionmaker
+
+
+def component_ids(engine, object_key, object_timestamp=None, start_time=None, end_time=None):
+    """The sorted ids of the components of the table of object_key.
+
+    They are read from the component table that object_key references (e.g. thermafuser for
+    ThermafuserReading._thermafuserId), which is small. Without a foreign key they are the distinct ids of the
+    readings between start_time and end_time, so the whole reading table is not scanned."""
+
+    foreign_keys = list(object_key.property.columns[0].foreign_keys)
+
+    if foreign_keys:
+        statement = select(foreign_keys[0].column).distinct().order_by(foreign_keys[0].column)
+    else:
+        statement = select(object_key).distinct().order_by(object_key)
+
+        if start_time is not None:
+            statement = statement.where(object_timestamp >= start_time)
+
+        if end_time is not None:
+            statement = statement.where(object_timestamp < end_time)
+
+    with engine.connect() as connection:
+        return [row[0] for row in connection.execute(statement)]
+
+
+class ReplayCursor:
+    """Streams the readings of several components ordered by (timestamp, component id).
+
+    Pages are fetched with keyset pagination in the order of the primary key of the reading table, so every page
+    is a range scan of the index, and each page is a single query over many component ids:
+    - when the primary key is (Time_stamp, <component>Id) (VFD, filter, thermafuser readings) the page filters
+      the ids with IN (...) and continues right after the (timestamp, id) of the last row of the previous page;
+    - when it is (<component>Id, Time_stamp) (AHU, damper, fan, HEC, SAV, VAV readings) the page is ordered by
+      (id, timestamp) and continues every id after the last timestamp read for it. The rows are merged back into
+      (timestamp, id) order and a row is released once no id still being read can have an earlier one, so at most
+      about page_size rows per id are held.
+    While a page is being consumed the next one is fetched in a background thread. All the queries go through
+    the given engine, so its connection pool is reused."""
+
+    def __init__(self, engine, object_type, object_key, object_timestamp, keys, start_time, end_time=None,
+                 page_size=1000, prefetch=True):
+
+        self.session_factory = sessionmaker(bind=engine)
+        self.object_type = object_type
+        self.object_key = object_key
+        self.object_timestamp = object_timestamp
+        self.keys = list(keys)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.logger = logging.getLogger(__name__)
+
+        self.key_major = class_mapper(object_type).primary_key[0] is object_key.property.columns[0]
+        self.pages = 0
+        self.rows = 0
+
+        # Key major tables: last timestamp read of every id not read to the end yet (None before the first row)
+        # and the rows fetched but not released
+        self._positions = {}
+        self._pending = []
+
+    def first_keyset(self):
+
+        if self.key_major:
+            self._positions = {key: None for key in self.keys}
+            self._pending = []
+
+            return dict(self._positions)
+
+        return None, None
+
+    def page_filters(self, keyset):
+        """Return the filters of the page of keyset, see first_keyset and advance"""
+
+        if self.key_major:
+            # One range of the primary key per id, the ids at the same position share an IN (...)
+            by_position = {}
+
+            for key, last_timestamp in keyset.items():
+                by_position.setdefault(last_timestamp, []).append(key)
+
+            ranges = [and_(self.object_key.in_(keys), self.object_timestamp >= self.start_time if last_timestamp is None
+                           else self.object_timestamp > last_timestamp) for last_timestamp, keys in by_position.items()]
+            filters = [or_(*ranges)]
+        else:
+            last_timestamp, last_key = keyset
+            filters = [self.object_key.in_(self.keys)]
+
+            if last_timestamp is None:
+                filters.append(self.object_timestamp >= self.start_time)
+            else:
+                filters.append(or_(self.object_timestamp > last_timestamp,
+                                   and_(self.object_timestamp == last_timestamp, self.object_key > last_key)))
+
+        if self.end_time is not None:
+            filters.append(self.object_timestamp < self.end_time)
+
+        return filters
+
+    def page_order(self):
+
+        if self.key_major:
+            return self.object_key, self.object_timestamp
+
+        return self.object_timestamp, self.object_key
+
+    def fetch_page(self, keyset):
+
+        session = self.session_factory()
+
+        try:
+            q = session.query(self.object_type).filter(*self.page_filters(keyset))
+            results = q.order_by(*self.page_order()).limit(self.page_size).all()
+        finally:
+            # The readings stay usable once detached, only their relationships can not be loaded anymore
+            session.close()
+
+        return results
+
+    def advance(self, keyset, page):
+        """Return the readings of page that can be released, in (timestamp, id) order, and the keyset of the next
+        page, None after the last one"""
+
+        timestamp_attr, key_attr = self.object_timestamp.key, self.object_key.key
+
+        if not self.key_major:
+            if len(page) < self.page_size:
+                return page, None
+
+            return page, (getattr(page[-1], timestamp_attr), getattr(page[-1], key_attr))
+
+        for reading in page:
+            self._pending.append(reading)
+            self._positions[getattr(reading, key_attr)] = getattr(reading, timestamp_attr)
+
+        # The page is in (id, timestamp) order: every id before the last one of a full page was read to the end
+        if len(page) < self.page_size:
+            done = list(keyset)
+        else:
+            done = [key for key in keyset if key < getattr(page[-1], key_attr)]
+
+        for key in done:
+            self._positions.pop(key, None)
+
+        sort_key = lambda reading: (getattr(reading, timestamp_attr), getattr(reading, key_attr))
+
+        if not self._positions:
+            ready, self._pending = sorted(self._pending, key=sort_key), []
+            return ready, None
+
+        unread = [key for key, last_timestamp in self._positions.items() if last_timestamp is None]
+
+        if unread:
+            return [], {key: None for key in unread}
+
+        # Any row still to come for an id is after its position, so everything up to the lowest one is final
+        horizon = min(self._positions.values())
+        ready = sorted((reading for reading in self._pending if getattr(reading, timestamp_attr) <= horizon), key=sort_key)
+        self._pending = [reading for reading in self._pending if getattr(reading, timestamp_attr) > horizon]
+
+        return ready, {key: last_timestamp for key, last_timestamp in self._positions.items() if last_timestamp == horizon}
+
+    def __iter__(self):
+
+        if not self.keys:
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if self.prefetch else None
+
+        try:
+            keyset = self.first_keyset()
+            page = self.fetch_page(keyset)
+
+            while True:
+                self.pages += 1
+                self.rows += len(page)
+
+                ready, keyset = self.advance(keyset, page)
+                next_page = None
+
+                if keyset is not None and executor is not None:
+                    next_page = executor.submit(self.fetch_page, keyset)
+
+                for reading in ready:
+                    yield reading
+
+                if keyset is None:
+                    break
+                elif next_page is not None:
+                    page = next_page.result()
+                else:
+                    page = self.fetch_page(keyset)
+
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+            self.logger.debug('Replay cursor read {} rows in {} pages'.format(self.rows, self.pages))
+
+
+class AsyncReplayCursor(ReplayCursor):
+    """ReplayCursor for asyncio producers, iterate it with async for.
+
+    async_engine is an AsyncEngine (see auxiliary.get_async_engine) and the next page is prefetched in a task."""
+
+    def __init__(self, async_engine, object_type, object_key, object_timestamp, keys, start_time, end_time=None,
+                 page_size=1000, prefetch=True):
+
+        from sqlalchemy.ext.asyncio import AsyncSession
+
+        super().__init__(async_engine, object_type, object_key, object_timestamp, keys, start_time, end_time,
+                         page_size, prefetch)
+        self.session_factory = sessionmaker(bind=async_engine, class_=AsyncSession)
+
+    async def fetch_page(self, keyset):
+
+        async with self.session_factory() as session:
+            q = select(self.object_type).where(*self.page_filters(keyset))
+            results = await session.execute(q.order_by(*self.page_order()).limit(self.page_size))
+
+            return results.scalars().all()
+
+    async def __aiter__(self):
+
+        if not self.keys:
+            return
+
+        next_page = None
+
+        try:
+            keyset = self.first_keyset()
+            page = await self.fetch_page(keyset)
+
+            while True:
+                self.pages += 1
+                self.rows += len(page)
+
+                ready, keyset = self.advance(keyset, page)
+                next_page = None
+
+                if keyset is not None and self.prefetch:
+                    next_page = asyncio.ensure_future(self.fetch_page(keyset))
+
+                for reading in ready:
+                    yield reading
+
+                if keyset is None:
+                    break
+                elif next_page is not None:
+                    page = await next_page
+                else:
+                    page = await self.fetch_page(keyset)
+
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+
+            self.logger.debug('Replay cursor read {} rows in {} pages'.format(self.rows, self.pages))
+
+
+class ReplayClock:
+    """Maps the timestamps of the replayed readings to the monotonic clock.
+
+    The clock is anchored on the first timestamp it is asked to wait for, after that a reading is released
+    (timestamp - first timestamp) / speedup seconds after the anchor, no matter how long sending the previous
+    readings took. speedup=None replays as fast as possible."""
+
+    def __init__(self, speedup=1.0):
+
+        if speedup is not None and speedup <= 0:
+            raise ValueError('speedup must be positive')
+
+        self.speedup = speedup
+        self.first_timestamp = None
+        self.wall_start = None
+
+    def delay(self, timestamp):
+        """Return how many seconds are left until the reading with this timestamp is due"""
+
+        if self.speedup is None:
+            return 0.0
+
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+            self.wall_start = time.monotonic()
+
+        due = self.wall_start + (timestamp - self.first_timestamp).total_seconds() / self.speedup
+
+        return due - time.monotonic()
+
+    def wait(self, timestamp):
+
+        delay = self.delay(timestamp)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, timestamp):
+
+        delay = self.delay(timestamp)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """Token bucket allowing rate units (records, requests...) per second, with bursts of up to burst units.
+
+    Used to stay under the service quotas when the replay runs faster than real time. It is thread safe."""
+
+    def __init__(self, rate, burst=None):
+
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else self.rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units=1):
+        """Take units from the bucket and return how many seconds the caller must wait before using them"""
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, units=1):
+
+        delay = self.reserve(units)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, units=1):
+
+        delay = self.reserve(units)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ThroughputMeter:
+    """Counts the records sent and logs the achieved records per second every report_secs. It is thread safe."""
+
+    def __init__(self, name, logger=None, report_secs=10.0):
+
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.report_secs = report_secs
+        self.total = 0
+        self.started = time.monotonic()
+
+        self._interval_count = 0
+        self._interval_start = self.started
+        self._lock = threading.Lock()
+
+    def add(self, records=1):
+
+        with self._lock:
+            self.total += records
+            self._interval_count += records
+
+            now = time.monotonic()
+            elapsed = now - self._interval_start
+
+            if elapsed < self.report_secs:
+                return
+
+            rate = self._interval_count / elapsed
+            self._interval_count = 0
+            self._interval_start = now
+
+        self.logger.warning('{}: {:.1f} records/s ({} records in total)'.format(self.name, rate, self.total))
+
+    def summary(self):
+
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+
+            return {'records': self.total, 'elapsed_secs': elapsed, 'records_per_sec': self.total / elapsed if elapsed > 0 else 0.0}
@@ -0,0 +1,731 @@
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import threading
+import time
+import traceback
+
+from sqlalchemy import Boolean, Float, Integer
+from sqlalchemy.orm import class_mapper
+
+from .replay import RateLimiter
+
+# SQLAlchemy column type -> (Timestream MeasureValueType, serializer)
+TIMESTREAM_TYPES = [
+    (Boolean, 'BOOLEAN', lambda value: 'true' if value else 'false'),
+    (Integer, 'BIGINT', str),
+    (Float, 'DOUBLE', repr),
+]
+
+_timestream_schemas = {}
+
+
+def timestream_schema(reading_class):
+    """Return {measure name: (MeasureValueType, serializer)} for a reading class of hvacDBMapping.
+
+    The measure names are the keys used by to_json, i.e. the mapped attribute without its leading underscore.
+    Primary key columns (component id and timestamp) are not measures. The schema is computed once per class."""
+
+    schema = _timestream_schemas.get(reading_class)
+
+    if schema is None:
+        schema = {}
+
+        for column_property in class_mapper(reading_class).column_attrs:
+            column = column_property.columns[0]
+
+            if column.primary_key:
+                continue
+
+            for column_type, measure_value_type, serializer in TIMESTREAM_TYPES:
+                if isinstance(column.type, column_type):
+                    schema[column_property.key.lstrip('_')] = (measure_value_type, serializer)
+                    break
+
+        _timestream_schemas[reading_class] = schema
+
+    return schema
+
+
+class TimestreamBatchWriter:
+    """Buffers Timestream records and writes them with multi-record write_records calls.
+
+    Timestream only accepts CommonAttributes that apply to the whole request, so records are buffered per
+    dimension set (one buffer per component). A buffer is flushed as soon as it holds batch_size records or
+    its oldest record is older than max_age_secs. The writer is thread safe and keeps flush metrics in
+    self.metrics, see stats()."""
+
+    MAX_RECORDS_PER_WRITE = 100
+
+    def __init__(self, client, database_name, table_name, batch_size=MAX_RECORDS_PER_WRITE, max_age_secs=1.0):
+
+        if batch_size < 1 or batch_size > self.MAX_RECORDS_PER_WRITE:
+            raise ValueError('batch_size must be between 1 and {}'.format(self.MAX_RECORDS_PER_WRITE))
+
+        self.client = client
+        self.database_name = database_name
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.max_age_secs = max_age_secs
+        self.logger = logging.getLogger(__name__)
+
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self.metrics = {'flushes': 0, 'failed_flushes': 0, 'records_written': 0, 'rejected_records': 0,
+                        'flush_latency_total': 0.0, 'flush_latency_max': 0.0, 'flush_latency_last': 0.0}
+
+    def add(self, dimensions, records):
+        """Buffer the records of one component. dimensions is the Timestream dimension list shared by all of them"""
+
+        ready = self._collect(dimensions, records)
+
+        for batch_dimensions, batch_records in ready:
+            self._write(batch_dimensions, batch_records)
+
+        return len(ready)
+
+    def flush_expired(self):
+        """Write every buffer whose oldest record is older than max_age_secs"""
+
+        with self._lock:
+            ready = self._take_expired(time.monotonic())
+
+        for batch_dimensions, batch_records in ready:
+            self._write(batch_dimensions, batch_records)
+
+        return len(ready)
+
+    def flush(self):
+        """Write every buffered record regardless of its age"""
+
+        ready = self._take_all()
+
+        for batch_dimensions, batch_records in ready:
+            self._write(batch_dimensions, batch_records)
+
+        return len(ready)
+
+    def stats(self):
+        """Return a snapshot of the flush metrics"""
+
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['buffered_records'] = sum(len(buffer['records']) for buffer in self._buffers.values())
+
+        stats['flush_latency_avg'] = stats['flush_latency_total'] / stats['flushes'] if stats['flushes'] else 0.0
+
+        return stats
+
+    def _collect(self, dimensions, records):
+        """Buffer the records and return the batches that are ready to be written"""
+
+        key = tuple((dimension['Name'], dimension['Value']) for dimension in dimensions)
+        ready = []
+
+        with self._lock:
+            now = time.monotonic()
+            buffer = self._buffers.get(key)
+
+            if buffer is None:
+                buffer = {'dimensions': dimensions, 'records': [], 'created': now}
+                self._buffers[key] = buffer
+
+            buffer['records'].extend(records)
+
+            while len(buffer['records']) >= self.batch_size:
+                ready.append((buffer['dimensions'], buffer['records'][:self.batch_size]))
+                del buffer['records'][:self.batch_size]
+                buffer['created'] = now
+
+            if not buffer['records']:
+                del self._buffers[key]
+
+            ready.extend(self._take_expired(now))
+
+        return ready
+
+    def _take_expired(self, now):
+        """Remove and return the expired buffers, the caller must hold the lock"""
+
+        expired = [key for key, buffer in self._buffers.items() if now - buffer['created'] >= self.max_age_secs]
+
+        return [(self._buffers[key]['dimensions'], self._buffers.pop(key)['records']) for key in expired]
+
+    def _take_all(self):
+
+        with self._lock:
+            ready = [(buffer['dimensions'], buffer['records']) for buffer in self._buffers.values()]
+            self._buffers = {}
+
+        return ready
+
+    def _build_request(self, dimensions, records):
+
+        return {'DatabaseName': self.database_name, 'TableName': self.table_name, 'Records': records,
+                'CommonAttributes': {'Dimensions': dimensions}}
+
+    def _check_result(self, result):
+
+        if result['ResponseMetadata']['HTTPStatusCode'] != 200:
+            self.logger.error('Status: ' + str(result['ResponseMetadata']))
+
+    def _write_error(self, err, records):
+        """Log a failed write_records call and return (rejected records, whether the whole call failed)"""
+
+        if isinstance(err, self.client.exceptions.RejectedRecordsException):
+            rejected_records = err.response.get('RejectedRecords', [])
+
+            for rejected_record in rejected_records:
+                self.logger.error('Rejected record {}: {}'.format(rejected_record.get('RecordIndex'), rejected_record.get('Reason')))
+
+            return len(rejected_records), False
+
+        self.logger.error('Error writing {} records to {}: {}'.format(len(records), self.table_name, err))
+        self.logger.error(traceback.format_exc())
+
+        return len(records), True
+
+    def _write(self, dimensions, records):
+
+        rejected = 0
+        failed = False
+        start = time.perf_counter()
+
+        try:
+            self._check_result(self.client.write_records(**self._build_request(dimensions, records)))
+        except Exception as err:
+            rejected, failed = self._write_error(err, records)
+
+        self._record_flush(len(records), rejected, failed, time.perf_counter() - start)
+
+    def _record_flush(self, num_records, rejected, failed, latency):
+
+        with self._lock:
+            self.metrics['flushes'] += 1
+            self.metrics['failed_flushes'] += 1 if failed else 0
+            self.metrics['records_written'] += num_records - rejected
+            self.metrics['rejected_records'] += rejected
+            self.metrics['flush_latency_total'] += latency
+            self.metrics['flush_latency_last'] = latency
+            self.metrics['flush_latency_max'] = max(self.metrics['flush_latency_max'], latency)
+
+
+class AsyncTimestreamBatchWriter(TimestreamBatchWriter):
+    """TimestreamBatchWriter for asyncio producers, client is an async (aiobotocore) timestream-write client.
+
+    add, flush and flush_expired are coroutines and the batches that are ready at the same time are written
+    concurrently. run_flusher writes the expired buffers in the background until it is cancelled."""
+
+    async def add(self, dimensions, records):
+
+        ready = self._collect(dimensions, records)
+        await asyncio.gather(*(self._write(batch_dimensions, batch_records) for batch_dimensions, batch_records in ready))
+
+        return len(ready)
+
+    async def flush_expired(self):
+
+        with self._lock:
+            ready = self._take_expired(time.monotonic())
+
+        await asyncio.gather(*(self._write(batch_dimensions, batch_records) for batch_dimensions, batch_records in ready))
+
+        return len(ready)
+
+    async def flush(self):
+
+        ready = self._take_all()
+        await asyncio.gather(*(self._write(batch_dimensions, batch_records) for batch_dimensions, batch_records in ready))
+
+        return len(ready)
+
+    async def run_flusher(self):
+
+        while True:
+            await asyncio.sleep(self.max_age_secs)
+            await self.flush_expired()
+
+    async def _write(self, dimensions, records):
+
+        rejected = 0
+        failed = False
+        start = time.perf_counter()
+
+        try:
+            self._check_result(await self.client.write_records(**self._build_request(dimensions, records)))
+        except Exception as err:
+            rejected, failed = self._write_error(err, records)
+
+        self._record_flush(len(records), rejected, failed, time.perf_counter() - start)
+
+
+class FirehoseBatchSink:
+    """Sends records to any number of Firehose delivery streams with put_record_batch.
+
+    Records are buffered per delivery stream and sent in batches of up to 500 records or 4 MiB, or when the
+    oldest buffered record is older than max_age_secs: a background thread, started by the first put, sends the
+    expired buffers every max_age_secs even while nothing is put (e.g. while a replay waits for its next reading)
+    until close() is called. Up to max_in_flight batches are sent concurrently, put
+    blocks when all of them are busy. Only the records that failed in a batch (see FailedPutCount and the
+    ErrorCode of each response) are retried, with exponential backoff. max_bytes_per_sec limits the bytes sent
+    to each delivery stream. The sink is thread safe and keeps its metrics in self.metrics, see stats()."""
+
+    BATCH_OPERATION = 'put_record_batch'
+    MAX_RECORDS_PER_BATCH = 500
+    MAX_BYTES_PER_BATCH = 4 * 1024 * 1024
+    MAX_BYTES_PER_RECORD = 1000 * 1024
+
+    def __init__(self, client, max_in_flight=4, max_age_secs=1.0, max_retries=5, retry_backoff_secs=0.1,
+                 max_bytes_per_sec=None):
+
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.max_age_secs = max_age_secs
+        self.max_retries = max_retries
+        self.retry_backoff_secs = retry_backoff_secs
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.logger = logging.getLogger(__name__)
+
+        self._buffers = {}
+        self._rate_limiters = {}
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self._flusher = None
+        self._closed = threading.Event()
+        self.metrics = {'batches': 0, 'records_sent': 0, 'records_retried': 0, 'records_failed': 0,
+                        'records_too_large': 0, 'error_codes': {}, 'batch_latency_total': 0.0, 'batch_latency_max': 0.0}
+
+    def put(self, stream_name, data):
+        """Buffer one record, data is a str or bytes"""
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._add(stream_name, data)
+
+    def _add(self, stream_name, record):
+
+        size = self._record_size(record)
+        key = self._buffer_key(stream_name, record)
+
+        if size > self.MAX_BYTES_PER_RECORD:
+            self.logger.error('Dropping a record of {} bytes for {}'.format(size, stream_name))
+
+            with self._lock:
+                self.metrics['records_too_large'] += 1
+
+            return
+
+        ready = []
+
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name='sink-flusher', daemon=True)
+                self._flusher.start()
+
+            now = time.monotonic()
+            buffer = self._buffers.get(key)
+
+            if buffer is not None and (len(buffer['records']) == self.MAX_RECORDS_PER_BATCH or
+                                       buffer['bytes'] + size > self.MAX_BYTES_PER_BATCH):
+                ready.append((key, self._buffers.pop(key)['records']))
+                buffer = None
+
+            if buffer is None:
+                buffer = {'records': [], 'bytes': 0, 'created': now}
+                self._buffers[key] = buffer
+
+            buffer['records'].append(record)
+            buffer['bytes'] += size
+
+            ready.extend(self._take_expired(now))
+
+        for batch_key, batch_records in ready:
+            self._submit(batch_key, batch_records)
+
+    def flush_expired(self):
+        """Send every buffer whose oldest record is older than max_age_secs"""
+
+        with self._lock:
+            ready = self._take_expired(time.monotonic())
+
+        for batch_key, batch_records in ready:
+            self._submit(batch_key, batch_records)
+
+    def flush(self):
+        """Send every buffered record and wait until all the batches in flight are done"""
+
+        with self._lock:
+            ready = [(key, buffer['records']) for key, buffer in self._buffers.items()]
+            self._buffers = {}
+
+        for batch_key, batch_records in ready:
+            self._submit(batch_key, batch_records)
+
+        # A batch that is done may start another one (see KinesisBatchSink), wait until none is left
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+
+            if not futures:
+                break
+
+            concurrent.futures.wait(futures)
+
+    def close(self):
+
+        self._closed.set()
+
+        if self._flusher is not None:
+            self._flusher.join()
+
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def _run_flusher(self):
+
+        while not self._closed.wait(self.max_age_secs):
+            try:
+                self.flush_expired()
+            except Exception:
+                self.logger.error('Sending the expired buffers failed: {}'.format(traceback.format_exc()))
+
+    def stats(self):
+
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['error_codes'] = dict(self.metrics['error_codes'])
+            stats['buffered_records'] = sum(len(buffer['records']) for buffer in self._buffers.values())
+            stats['batches_in_flight'] = len(self._futures)
+
+        stats['batch_latency_avg'] = stats['batch_latency_total'] / stats['batches'] if stats['batches'] else 0.0
+
+        return stats
+
+    def _take_expired(self, now):
+        """Remove and return the expired buffers, the caller must hold the lock"""
+
+        expired = [key for key, buffer in self._buffers.items() if now - buffer['created'] >= self.max_age_secs]
+
+        return [(key, self._buffers.pop(key)['records']) for key in expired]
+
+    def _buffer_key(self, stream_name, record):
+        """The buffer of a record, a batch only holds records of the same buffer"""
+
+        return stream_name
+
+    def _stream_name(self, key):
+
+        return key
+
+    def _submit(self, key, records):
+
+        # Blocks the producer while max_in_flight batches are being sent
+        self._in_flight.acquire()
+
+        future = self._executor.submit(self._send, key, records)
+
+        with self._lock:
+            self._futures.add(future)
+
+        future.add_done_callback(self._batch_done)
+
+    def _batch_done(self, future):
+
+        if future.exception() is not None:
+            self.logger.error('Sending a batch failed: {}'.format(future.exception()))
+
+        with self._lock:
+            self._futures.discard(future)
+
+        self._in_flight.release()
+
+    def _rate_limiter(self, stream_name):
+
+        with self._lock:
+            rate_limiter = self._rate_limiters.get(stream_name)
+
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(self.max_bytes_per_sec)
+                self._rate_limiters[stream_name] = rate_limiter
+
+        return rate_limiter
+
+    def _record_size(self, record):
+
+        return len(record)
+
+    def _throttle(self, stream_name, records):
+        """Wait until records can be sent without going over the rate limits"""
+
+        if self.max_bytes_per_sec:
+            self._rate_limiter(stream_name).acquire(sum(len(record) for record in records))
+
+    def _put_batch(self, stream_name, records):
+        """Send records in one call, return the records that failed and their error codes"""
+
+        result = self.client.put_record_batch(DeliveryStreamName=stream_name, Records=[{'Data': record} for record in records])
+
+        if result['FailedPutCount'] == 0:
+            return [], []
+
+        failed = [record for record, response in zip(records, result['RequestResponses']) if 'ErrorCode' in response]
+        error_codes = [response['ErrorCode'] for response in result['RequestResponses'] if 'ErrorCode' in response]
+
+        return failed, error_codes
+
+    def _send(self, key, records):
+
+        stream_name = self._stream_name(key)
+        pending = records
+        attempt = 0
+        start = time.perf_counter()
+
+        while pending:
+
+            self._throttle(stream_name, pending)
+
+            failed = pending
+
+            try:
+                failed, error_codes = self._put_batch(stream_name, pending)
+
+            except Exception as err:
+                self.logger.error('{} to {} failed: {}'.format(self.BATCH_OPERATION, stream_name, err))
+                error_codes = [type(err).__name__] * len(pending)
+
+            with self._lock:
+                self.metrics['records_sent'] += len(pending) - len(failed)
+
+                for error_code in error_codes:
+                    self.metrics['error_codes'][error_code] = self.metrics['error_codes'].get(error_code, 0) + 1
+
+            if not failed:
+                break
+
+            attempt += 1
+
+            if attempt > self.max_retries:
+                self.logger.error('Giving up on {} records for {} after {} retries'.format(len(failed), stream_name, self.max_retries))
+
+                with self._lock:
+                    self.metrics['records_failed'] += len(failed)
+
+                break
+
+            with self._lock:
+                self.metrics['records_retried'] += len(failed)
+
+            time.sleep(self.retry_backoff_secs * 2 ** (attempt - 1))
+            pending = failed
+
+        latency = time.perf_counter() - start
+
+        with self._lock:
+            self.metrics['batches'] += 1
+            self.metrics['batch_latency_total'] += latency
+            self.metrics['batch_latency_max'] = max(self.metrics['batch_latency_max'], latency)
+
+
+class KinesisBatchSink(FirehoseBatchSink):
+    """Sends records to any number of Kinesis data streams with put_records.
+
+    Buffering, concurrency and retries work as in FirehoseBatchSink, with batches of up to 500 records or 5 MiB
+    (data plus partition keys). Every record goes to the shard whose hash key range holds the MD5 of its partition
+    key, so the sink reads the shards of every stream (again every shard_refresh_secs) and waits before a batch
+    until every shard it writes to is under its quota of 1000 records and 1 MiB per second.
+
+    Records are buffered per shard and only one batch of a shard is sent at a time, the next one waits until the
+    records that failed in it were retried, so the records of a partition key are written in the order they were
+    put. Within a batch, a retried record can still land after records of its key that succeeded on the first try."""
+
+    BATCH_OPERATION = 'put_records'
+    MAX_RECORDS_PER_BATCH = 500
+    MAX_BYTES_PER_BATCH = 5 * 1024 * 1024
+    MAX_BYTES_PER_RECORD = 1024 * 1024
+    SHARD_RECORDS_PER_SEC = 1000
+    SHARD_BYTES_PER_SEC = 1024 * 1024
+
+    def __init__(self, client, max_in_flight=4, max_age_secs=1.0, max_retries=5, retry_backoff_secs=0.1,
+                 shard_refresh_secs=60.0):
+
+        super().__init__(client, max_in_flight, max_age_secs, max_retries, retry_backoff_secs)
+
+        self.shard_refresh_secs = shard_refresh_secs
+        self._shard_maps = {}
+        self._shard_limiters = {}
+        # Batches waiting for the batch of their shard in flight, keyed by (stream name, shard id)
+        self._shard_queues = {}
+        self.metrics['records_per_shard'] = {}
+
+    def put(self, stream_name, data, partition_key):
+        """Buffer one record, data is a str or bytes and partition_key a str (e.g. the component id)"""
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._add(stream_name, (data, str(partition_key)))
+
+    def stats(self):
+
+        stats = super().stats()
+
+        with self._lock:
+            stats['records_per_shard'] = dict(self.metrics['records_per_shard'])
+
+        return stats
+
+    def _record_size(self, record):
+
+        data, partition_key = record
+
+        return len(data) + len(partition_key.encode('utf-8'))
+
+    def _shard_map(self, stream_name):
+        """(sorted starting hash keys, shard ids) of the open shards of a stream"""
+
+        with self._lock:
+            shard_map = self._shard_maps.get(stream_name)
+
+        if shard_map is not None and time.monotonic() - shard_map[2] < self.shard_refresh_secs:
+            return shard_map
+
+        shards = []
+        kwargs = {'StreamName': stream_name}
+
+        while True:
+            out = self.client.list_shards(**kwargs)
+            shards.extend(out['Shards'])
+
+            if 'NextToken' not in out:
+                break
+
+            kwargs = {'NextToken': out['NextToken']}
+
+        # Closed shards have an ending sequence number and take no more writes
+        ranges = sorted((int(shard['HashKeyRange']['StartingHashKey']), shard['ShardId']) for shard in shards
+                        if 'EndingSequenceNumber' not in shard['SequenceNumberRange'])
+        shard_map = ([start for start, _ in ranges], [shard_id for _, shard_id in ranges], time.monotonic())
+
+        with self._lock:
+            self._shard_maps[stream_name] = shard_map
+
+        return shard_map
+
+    def _buffer_key(self, stream_name, record):
+
+        try:
+            return stream_name, self._shard_id(self._shard_map(stream_name), record[1])
+        except Exception as err:
+            # The records of the stream share one buffer until its shards can be listed
+            self.logger.error('list_shards of {} failed: {}'.format(stream_name, err))
+            return stream_name, None
+
+    def _stream_name(self, key):
+
+        return key[0]
+
+    def _submit(self, key, records):
+
+        self._in_flight.acquire()
+
+        with self._lock:
+            queue = self._shard_queues.get(key)
+
+            if queue is not None:
+                queue.append(records)
+                return
+
+            self._shard_queues[key] = collections.deque()
+
+        self._start(key, records)
+
+    def _start(self, key, records):
+
+        future = self._executor.submit(self._send, key, records)
+
+        with self._lock:
+            self._futures.add(future)
+
+        future.add_done_callback(functools.partial(self._shard_batch_done, key))
+
+    def _shard_batch_done(self, key, future):
+
+        with self._lock:
+            queue = self._shard_queues[key]
+            records = queue.popleft() if queue else None
+
+            if records is None:
+                del self._shard_queues[key]
+
+        # The next batch is started before this one is released, so flush never sees an idle shard with a queue
+        if records is not None:
+            self._start(key, records)
+
+        self._batch_done(future)
+
+    def _shard_id(self, shard_map, partition_key):
+
+        hash_key = int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+
+        return shard_map[1][bisect.bisect_right(shard_map[0], hash_key) - 1]
+
+    def _shard_rate_limiters(self, stream_name, shard_id):
+
+        with self._lock:
+            limiters = self._shard_limiters.get((stream_name, shard_id))
+
+            if limiters is None:
+                limiters = (RateLimiter(self.SHARD_RECORDS_PER_SEC), RateLimiter(self.SHARD_BYTES_PER_SEC))
+                self._shard_limiters[(stream_name, shard_id)] = limiters
+
+        return limiters
+
+    def _throttle(self, stream_name, records):
+
+        try:
+            shard_map = self._shard_map(stream_name)
+        except Exception as err:
+            # put_records reports the throttled records, they are retried
+            self.logger.error('list_shards of {} failed: {}'.format(stream_name, err))
+            return
+
+        per_shard = {}
+
+        for record in records:
+            shard_id = self._shard_id(shard_map, record[1])
+            count, size = per_shard.get(shard_id, (0, 0))
+            per_shard[shard_id] = (count + 1, size + self._record_size(record))
+
+        delay = 0.0
+
+        for shard_id, (count, size) in per_shard.items():
+            records_limiter, bytes_limiter = self._shard_rate_limiters(stream_name, shard_id)
+            delay = max(delay, records_limiter.reserve(count), bytes_limiter.reserve(size))
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _put_batch(self, stream_name, records):
+
+        result = self.client.put_records(StreamName=stream_name,
+                                         Records=[{'Data': data, 'PartitionKey': partition_key} for data, partition_key in records])
+
+        with self._lock:
+            for response in result['Records']:
+                if 'ShardId' in response:
+                    self.metrics['records_per_shard'][response['ShardId']] = self.metrics['records_per_shard'].get(response['ShardId'], 0) + 1
+
+        if result.get('FailedRecordCount', 0) == 0:
+            return [], []
+
+        failed = [record for record, response in zip(records, result['Records']) if 'ErrorCode' in response]
+        error_codes = [response['ErrorCode'] for response in result['Records'] if 'ErrorCode' in response]
+
+        return failed, error_codes
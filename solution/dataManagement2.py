@@ -2,26 +2,31 @@ import numpy as np
 import pandas as pd
 import sqlalchemy
 import logging
+import re
+import time
 from hvacDBMapping import *
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
-from sqlalchemy import and_
-from copy import copy
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select
+from sqlalchemy.orm import class_mapper
+from concurrent.futures import ThreadPoolExecutor
 
 class DataManager:
 	"""Used to manage the access to the data stored in the database"""
 
-	def __init__(self, user="", password="", engineType="mysql+mysqldb://", dbName="hvac2018_04", host="localhost", port="3306"):
-		"""Attempt to stablish a connection to the database"""
+	def __init__(self, user="", password="", engineType="mysql+mysqldb://", dbName="hvac2018_04", host="localhost", port="3306", poolSize=8):
+		"""Attempt to stablish a connection to the database. poolSize is the number of pooled connections the parallel reads of readData can use"""
 
 		#Object variables
 		self.dbSession = None
+		self.lastShardReport = []
+		self._columnMetadata = dict()
 
 		databaseString = engineType + user + ":" + password + "@" + host + ":" + port + "/" + dbName
 
 		#Attempt connection to the database
 		try:
-			sqlengine = sqlalchemy.create_engine(databaseString)
+			sqlengine = sqlalchemy.create_engine(databaseString, pool_size=poolSize, max_overflow=poolSize, pool_pre_ping=True)
 			Session = sessionmaker(bind=sqlengine)
 			self.dbSession = Session()
 
@@ -61,114 +66,222 @@ class DataManager:
 		return componentClass
 
 
-	def readData(self, startTimestamp, endTimestamp, componentTypes = []):
-		"""Return a list of dataframes with the data for each of the components in componentTypes in the indicated period"""
+	def componentColumnArray(self, values, columnType):
+		"""Turn the list of values of a column into a numpy array with the dtype pandas would have inferred for it"""
 
-		#THIS MUST BE PARALLELIZED ON ORDER TO ACHIEVE ITS MAXIMUM PERFORMANCE
+		hasNulls = any(value is None for value in values)
+
+		if isinstance(columnType, sqlalchemy.Float):
+			return np.array(values, dtype=np.float64)
+		elif isinstance(columnType, sqlalchemy.Boolean):
+			return np.array(values, dtype=object if hasNulls else bool)
+		elif isinstance(columnType, sqlalchemy.Integer):
+			return np.array(values, dtype=np.float64 if hasNulls else np.int64)
+		elif isinstance(columnType, sqlalchemy.DateTime):
+			return np.array(values, dtype='datetime64[ns]')
+		else:
+			return np.array(values, dtype=object)
+
+
+	def readComponentDataFrame(self, componentReadingClass, startTimestamp, endTimestamp, chunkSize=10000):
+		"""Read the readings of componentReadingClass in [startTimestamp, endTimestamp) with a Core select and return them as a dataframe.
+
+		The rows are streamed from a server side cursor chunkSize at a time and go straight into column arrays, no ORM
+		objects are built. The columns are named after the attributes of the class (_timestamp, _thermafuserId...)."""
+
+		columnProperties = class_mapper(componentReadingClass).column_attrs
+		columnKeys = [columnProperty.key for columnProperty in columnProperties]
+		columnTypes = [columnProperty.columns[0].type for columnProperty in columnProperties]
+
+		query = select(*[columnProperty.columns[0] for columnProperty in columnProperties])\
+			.where(and_(componentReadingClass._timestamp >= startTimestamp, componentReadingClass._timestamp < endTimestamp))\
+			.order_by(*class_mapper(componentReadingClass).primary_key)
+
+		columns = [list() for key in columnKeys]
+
+		with self.dbSession.get_bind().connect() as connection:
+			result = connection.execution_options(yield_per=chunkSize).execute(query)
+
+			for rows in result.partitions():
+				for column, values in zip(columns, zip(*rows)):
+					column.extend(values)
+
+		if not columns or not columns[0]:
+			return None
+
+		return pd.DataFrame({key:self.componentColumnArray(values, columnType) for key, values, columnType in zip(columnKeys, columns, columnTypes)}, copy=False)
+
+
+	def timeShards(self, startTimestamp, endTimestamp, shardSize):
+		"""Split [startTimestamp, endTimestamp) into consecutive [start, end) ranges of at most shardSize"""
+
+		shardStart = pd.Timestamp(startTimestamp).to_pydatetime()
+		endTimestamp = pd.Timestamp(endTimestamp).to_pydatetime()
+		shards = []
+
+		while shardStart < endTimestamp:
+			shardEnd = min(shardStart + shardSize, endTimestamp)
+			shards.append((shardStart, shardEnd))
+			shardStart = shardEnd
+
+		return shards
+
+
+	def readShard(self, componentReadingClass, shardStart, shardEnd):
+		"""Read one time shard of a component class, return the dataframe (None if empty) and the shard report"""
+
+		start = time.perf_counter()
+		frame = self.readComponentDataFrame(componentReadingClass, shardStart, shardEnd)
+
+		shardReport = {'component': componentReadingClass.__name__, 'start': shardStart, 'end': shardEnd,
+			'rows': 0 if frame is None else len(frame), 'seconds': time.perf_counter() - start}
+
+		return frame, shardReport
+
+
+	def readData(self, startTimestamp, endTimestamp, componentTypes = [], maxWorkers=4, shardSize=timedelta(days=1)):
+		"""Return a list of dataframes with the data for each of the components in componentTypes in the indicated period.
+
+		The period is split in shards of shardSize for every component class and the shards are read by a pool of
+		maxWorkers threads, each over its own pooled connection. The shards of a component are concatenated in time
+		order. The timing of every shard is logged and kept in self.lastShardReport."""
 
 		if self.dbSession == None:
 			print('Session not initialized')
 			return
 
-		dataFrames = dict()
-		readings = dict()
-
-		count = 0
-
 		componentsReadingClass = [self.getComponentReadingClassByType(component) for component in componentTypes]
+		shards = self.timeShards(startTimestamp, endTimestamp, shardSize)
 
 		#This goes to the log
-		logging.debug('Loading data for components {} from {} to {}'.format(componentsReadingClass, startTimestamp, endTimestamp))
+		logging.debug('Loading data for components {} from {} to {} in {} shards'.format(componentsReadingClass, startTimestamp, endTimestamp, len(shards)))
 
-		#Create the dataframes for each component
-		for componentReadingClass in componentsReadingClass:
-			readings = \
-			self.dbSession.query(componentReadingClass).filter(and_(componentReadingClass._timestamp >= startTimestamp, componentReadingClass._timestamp < endTimestamp)).all()
+		start = time.perf_counter()
 
-			if readings != []:
-				#build the dictionary object
-				dictionaryOfReadings = copy(readings[0]).__dict__
-				dictionaryOfReadings.pop('_sa_instance_state')
+		with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+			futures = [[executor.submit(self.readShard, componentReadingClass, shardStart, shardEnd) for shardStart, shardEnd in shards]
+				for componentReadingClass in componentsReadingClass]
 
-				#This is performed fast, no need to change it
-				for key in dictionaryOfReadings:
-					dictionaryOfReadings[key] = list()
+			results = [[future.result() for future in componentFutures] for componentFutures in futures]
 
-				keys = dictionaryOfReadings.keys()
-				
-				#Can we make this perform faster?
-				for reading in readings:
-					readingAsDict = reading.__dict__
-					readingAsDict.pop('_sa_instance_state')
+		dataFrames = dict()
+		self.lastShardReport = []
 
-					#Can we write a map function (functional programming) for this?
-					for key in keys:
-						dictionaryOfReadings[key].append(readingAsDict[key])
+		for componentType, componentResults in zip(componentTypes, results):
+			frames = [frame for frame, shardReport in componentResults if frame is not None]
+			self.lastShardReport.extend(shardReport for frame, shardReport in componentResults)
 
-				dataFrames[componentTypes[count] + 'Readings'] =  pd.DataFrame.from_dict(dictionaryOfReadings)
+			#Component types without readings in the period are left out
+			if frames != []:
+				dataFrames[componentType + 'Readings'] = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
 
-			count += 1
+		for shardReport in self.lastShardReport:
+			logging.info('{component} {start} - {end}: {rows} rows in {seconds:.3f}s'.format(**shardReport))
 
-			return dataFrames
+		logging.info('Read {} shards with {} workers in {:.3f}s'.format(len(self.lastShardReport), maxWorkers, time.perf_counter() - start))
 
+		return dataFrames
 
-	def reshapeAndCleanDataFrame(self, dataFrame, removeSetpoints=False, removeRequests=False, removeBooleans=False):
-		"""Reshape the dataframe and return the dataframe reshaped. For each dataframe keep only the data/features that may result useful for the analysis
-		for instance it makes no sense to keep boolean values since they are not drawn from a gaussian distribution but instead a binary distribution, 
-		and thus they can not be fitted into a gausssian one. Same with setpoints, they are fixed values."""
-
-		#clean dataframe and reshape it
-		df = dataFrame
-		dropColumns = None
-
-		newColumnNames = {column:column.replace('_', "") for column in df.columns}
-		df.rename(columns=newColumnNames, inplace=True)
-		
-		#Get the Id Column
-		idColumn = list(filter(lambda colName: 'Id' in colName or 'Number' in colName, newColumnNames.values()))
-		if len(idColumn) != 1:
-		    print('Could not determine Id Column')
-		else:
-		    idColumn = idColumn[0]
 
-		indexColumns = ['timestamp']
+	def columnFlags(self, name, isPrimaryKey, isBoolean):
+		"""Return the cleaning flags of a column given its name (attribute key without '_'), if it is part of the primary key and if it holds booleans"""
 
-		dataColumns = list(filter(lambda colName: idColumn != colName and colName != 'timestamp', newColumnNames.values()))
+		lowerName = name.lower()
 
-		#Remove setpoint related columns
-		if removeSetpoints == True:
-			dropColumns = list(filter(lambda colName: 'setpoint' in colName.lower() or 'stpnt' in colName.lower(), newColumnNames.values()))
+		return {'timestamp': name == 'timestamp',
+			'id': isPrimaryKey and name != 'timestamp',
+			'setpoint': 'setpoint' in lowerName or 'stpnt' in lowerName or re.search('sp[0-9]*$', lowerName) is not None,
+			'request': 'request' in lowerName or 'req' in lowerName,
+			'boolean': isBoolean}
 
-		#Remove request related columns
-		if removeRequests == True:
-			dropColumns += list(filter(lambda colName: "request" in colName.lower() or "req" in colName.lower(), newColumnNames.values()))
 
-		#Remove boolean columns
-		if removeBooleans == True:
-			dropColumns += list(filter(lambda colName: df[colName].dtype == bool, newColumnNames.values()))
+	def columnMetadata(self, componentReadingClass):
+		"""Return the flags of every column of a reading class, keyed by the column name reshapeAndCleanDataFrame uses"""
 
-		#drop the undesired columns
-		if dropColumns != None:
-			df.drop(dropColumns, axis=1, inplace=True)
-		
-		df.set_index(indexColumns, inplace=True)
-		df.dropna(axis=1, how='all', inplace=True)
+		if componentReadingClass not in self._columnMetadata:
+			self._columnMetadata[componentReadingClass] = {columnProperty.key.replace('_', ''):
+				self.columnFlags(columnProperty.key.replace('_', ''), columnProperty.columns[0].primary_key, isinstance(columnProperty.columns[0].type, sqlalchemy.Boolean))
+				for columnProperty in class_mapper(componentReadingClass).column_attrs}
 
-		currentColumns = df.columns.values.tolist()
+		return self._columnMetadata[componentReadingClass]
 
-		currentColumns.remove(idColumn)
 
-		#when there is a -1 in the data, replace it by NaN
-		df.replace(-1, value=np.nan, inplace=True)
-		df.dropna(axis=0, how='all', inplace=True, subset=currentColumns)
-		#df.fillna(value=-1)
+	def getComponentReadingClassByColumns(self, columns):
+		"""Return the reading class whose columns match the most columns of a dataframe, None if none of them has its id column"""
 
-		#dataFrames[dfkey].fillna(value=nan, inplace=True)
+		columnNames = {column.replace('_', '') for column in columns}
+		componentClass = None
+		bestMatches = 0
 
-		return df
+		for componentType in ["AHU", "VFD", "Filter", "Damper", "Fan", "HEC", "SAV", "VAV", "Thermafuser"]:
+			componentReadingClass = self.getComponentReadingClassByType(componentType)
+			metadata = self.columnMetadata(componentReadingClass)
+			matches = len(columnNames & set(metadata))
 
+			if any(flags['id'] and name in columnNames for name, flags in metadata.items()) and matches > bestMatches:
+				componentClass, bestMatches = componentReadingClass, matches
 
+		return componentClass
 
 
+	def reshapeAndCleanDataFrame(self, dataFrame, removeSetpoints=False, removeRequests=False, removeBooleans=False, componentReadingClass=None):
+		"""Reshape the dataframe and return the dataframe reshaped. For each dataframe keep only the data/features that may result useful for the analysis
+		for instance it makes no sense to keep boolean values since they are not drawn from a gaussian distribution but instead a binary distribution, 
+		and thus they can not be fitted into a gausssian one. Same with setpoints, they are fixed values.
+
+		Which columns are setpoints, requests, booleans or the id is taken from hvacDBMapping (componentReadingClass is guessed
+		from the columns if not given, the names are used for columns that are not mapped). Each column is converted once:
+		numbers become float32 with -1 replaced by NaN, booleans nullable booleans, text categoricals and the id the
+		smallest integer type that fits. The input dataframe is not modified."""
+
+		bytesBefore = dataFrame.memory_usage(deep=True).sum()
+
+		if componentReadingClass is None:
+			componentReadingClass = self.getComponentReadingClassByColumns(dataFrame.columns)
+
+		metadata = self.columnMetadata(componentReadingClass) if componentReadingClass is not None else dict()
+
+		idColumn = None
+		columns = dict()
+
+		for column in dataFrame.columns:
+			name = column.replace('_', "")
+			values = dataFrame[column]
+			flags = metadata.get(name)
+
+			if flags is None:
+				flags = self.columnFlags(name, 'Id' in name or 'Number' in name, pd.api.types.is_bool_dtype(values))
+
+			#Remove the undesired columns
+			if (removeSetpoints and flags['setpoint']) or (removeRequests and flags['request']) or (removeBooleans and flags['boolean']):
+				continue
+
+			if flags['timestamp']:
+				columns[name] = values.to_numpy()
+			elif flags['id']:
+				idColumn = name
+				columns[name] = pd.to_numeric(values, downcast='integer').to_numpy()
+			elif flags['boolean']:
+				columns[name] = values.astype('boolean').array
+			elif pd.api.types.is_numeric_dtype(values):
+				#when there is a -1 in the data, replace it by NaN
+				array = values.to_numpy(dtype=np.float32, na_value=np.nan)
+				array[array == -1] = np.nan
+				columns[name] = array
+			else:
+				columns[name] = values.astype('category').array
+
+		if idColumn is None:
+			print('Could not determine Id Column')
+
+		df = pd.DataFrame(columns, copy=False)
+		df.set_index('timestamp', inplace=True)
+		df.dropna(axis=1, how='all', inplace=True)
+
+		currentColumns = [column for column in df.columns if column != idColumn]
 
+		df.dropna(axis=0, how='all', inplace=True, subset=currentColumns)
 
+		logging.info('Reshaped dataframe uses {} bytes, {} bytes saved'.format(df.memory_usage(deep=True).sum(), bytesBefore - df.memory_usage(deep=True).sum()))
+
+		return df
@@ -1,15 +1,25 @@
+import argparse
 import logging
 import boto3
-import time
+
+from common import consumer
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
 
-    shard_id = 'shardId-000000000000'  # we only have one shard!
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stream-name', default='StockTradeStream')
+    parser.add_argument('--region', default='us-west-2')
+    parser.add_argument('--checkpoint-db', default='kinesis_checkpoints.db', help='SQLite file with the checkpoints of the shards')
+    parser.add_argument('--initial-position', default='LATEST', choices=['LATEST', 'TRIM_HORIZON'],
+                        help='Where to start reading a shard without checkpoint')
+    parser.add_argument('--limit', type=int, default=10000, help='Records per get_records call (at most 10000)')
+    parser.add_argument('--report-secs', type=float, default=30.0, help='Seconds between lag reports')
+    args = parser.parse_args()
 
     app_logger = logging.getLogger('consumer_logger')
-    app_logger.setLevel(logging.WARNING)
+    app_logger.setLevel(logging.INFO)
     app_fh = logging.FileHandler('LogFiles/producer.log')
     app_formatter = logging.Formatter(
         fmt='%(levelname)s:%(threadName)s:%(asctime)s:%(filename)s:%(funcName)s:%(message)s',
@@ -17,19 +27,25 @@ if __name__ == '__main__':
     app_fh.setFormatter(app_formatter)
     app_logger.addHandler(app_fh)
 
-    app_logger.error("This is a test")
-
-    #test_boto()
-    kinesis_client = boto3.client('kinesis', region_name='us-west-2')
-    print(kinesis_client.list_streams())
-
-    shard_it = kinesis_client.get_shard_iterator(StreamName="StockTradeStream", ShardId=shard_id, ShardIteratorType="LATEST")["ShardIterator"]
+    kinesis_client = boto3.client('kinesis', region_name=args.region)
+    checkpoints = consumer.CheckpointStore(args.checkpoint_db)
 
-    while True:
+    def process(shard_id, records):
+        app_logger.info('{}: {} records, last sequence number {}'.format(shard_id, len(records), records[-1]['SequenceNumber']))
 
-        out = kinesis_client.get_records(ShardIterator=shard_it, Limit=2)
-        shard_it = out["NextShardIterator"]
-        print(out)
-        time.sleep(5)
+    def report(lag_metrics):
+        for shard_id, metrics in sorted(lag_metrics.items()):
+            app_logger.info('{}: {} ms behind latest, {} records, {} throttled calls'.format(
+                shard_id, metrics['millis_behind_latest'], metrics['records'], metrics['throttled']))
 
+    kinesis_consumer = consumer.KinesisConsumer(kinesis_client, args.stream_name, process, checkpoints,
+                                                initial_position=args.initial_position, limit=args.limit)
 
+    try:
+        kinesis_consumer.run(report_secs=args.report_secs, report=report)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        kinesis_consumer.stop()
+        report(kinesis_consumer.lag_metrics())
+        checkpoints.close()
@@ -1,17 +1,155 @@
 "Lambda function Calculator exercise"
 from __future__ import print_function
-import re
+import math
 import boto3
-import pandas as pd
 import json
 
+# Bytes read from the S3 body at a time, and compression of the quantile digests (about that many centroids each)
+READ_CHUNK_SIZE = 1024 * 1024
+DIGEST_COMPRESSION = 100
+QUANTILES = [0.25, 0.5, 0.75]
+
+
+class TDigest(object):
+    "Merging t-digest, approximate quantiles of a stream in constant memory"
+
+    def __init__(self, compression=DIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.total = 0
+        self.buffer = []
+
+    def add(self, value):
+        self.buffer.append(value)
+
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        "Merge the buffered values into the centroids, a centroid holds at most one unit of the scale function"
+        if not self.buffer:
+            return
+
+        points = sorted(list(zip(self.means, self.weights)) + [(value, 1) for value in self.buffer])
+        self.buffer = []
+        self.total = sum(weight for _, weight in points)
+
+        means, weights = [], []
+        mean, weight = points[0]
+        weight_before = 0
+        q_limit = self._q(self._k(0) + 1)
+
+        for point_mean, point_weight in points[1:]:
+            if (weight_before + weight + point_weight) / self.total <= q_limit:
+                weight += point_weight
+                mean += (point_mean - mean) * point_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                weight_before += weight
+                q_limit = self._q(self._k(weight_before / self.total) + 1)
+                mean, weight = point_mean, point_weight
+
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q, minimum, maximum):
+        "Interpolate between the centers of the centroids, and the minimum and maximum at the ends"
+        self.compress()
+
+        if not self.means:
+            return None
+
+        target = q * self.total
+        previous_center, previous_mean = 0, minimum
+        center = 0
+
+        for mean, weight in zip(self.means, self.weights):
+            center += weight / 2
+
+            if target <= center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+
+            previous_center, previous_mean = center, mean
+            center += weight / 2
+
+        if self.total == previous_center:
+            return maximum
+        return previous_mean + (maximum - previous_mean) * (target - previous_center) / (self.total - previous_center)
+
+
+class RunningStats(object):
+    "Count, mean and variance (Welford), minimum, maximum and quantiles of a numeric field"
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.digest = TDigest()
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        self.digest.add(value)
+
+    def summary(self):
+        "Same statistics as DataFrame.describe, std is the sample standard deviation"
+        summary = {'count': self.count, 'mean': self.mean,
+                   'std': math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None,
+                   'min': self.min, 'max': self.max}
+
+        for q in QUANTILES:
+            summary['%d%%' % (q * 100)] = self.digest.quantile(q, self.min, self.max)
+
+        return summary
+
+
+def aggregate_lines(lines):
+    "Running statistics of every numeric field of an iterable of JSON lines, and the number of records"
+    stats = {}
+    records = 0
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        records += 1
+
+        for field, value in json.loads(line).items():
+            # bool is an int but DataFrame.describe leaves it out of the numeric fields
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value):
+                if field not in stats:
+                    stats[field] = RunningStats()
+                stats[field].add(value)
+
+    return stats, records
+
+
 def lambda_handler(event, context):
     "Process upload event"
     bucket = event['Records'][0]["s3"]["bucket"]["name"]
     key = event['Records'][0]["s3"]["object"]["key"]
 
-    result = None
-
     print("Received event. Bucket: [%s], Key: [%s]" % (bucket, key))
 
     # construct s3 client
@@ -21,19 +159,13 @@ def lambda_handler(event, context):
         Key=key
     )
 
-    # get the object contents
-    file_contents = response['Body'].read().decode("utf-8").strip().split('\n')
-    file_contents_json = [json.loads(x) for x in file_contents]
-    df = pd.DataFrame(file_contents_json)
-    aggregated_data = df.describe().to_dict()
-
-    #print(df)
-    #print(aggregated_data)
-
-
+    # stream the object contents line by line, only the running statistics are kept in memory
+    stats, records = aggregate_lines(response['Body'].iter_lines(chunk_size=READ_CHUNK_SIZE))
 
+    result = {'bucket': bucket, 'key': key, 'records': records,
+              'fields': {field: field_stats.summary() for field, field_stats in stats.items()}}
 
-    print("Result: %s" % result)
+    print("Result: %s" % json.dumps(result, separators=(',', ':')))
     return result
 
 # This is used for debugging, it will only execute when run locally
@@ -56,4 +188,4 @@ if __name__ == "__main__":
     }
 
     fake_context = []
-    lambda_handler(fake_s3_event, fake_context)
\ No newline at end of file
+    lambda_handler(fake_s3_event, fake_context)
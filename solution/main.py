@@ -1,3 +1,4 @@
+import argparse
 import logging
 import time
 import boto3
@@ -8,19 +9,18 @@ import datetime
 from multiprocessing import Pool
 import concurrent.futures
 
-from common import auxiliary
+from common import auxiliary, replay, sinks
 from db import hvacDBMapping
 
-from sqlalchemy import and_
 
 read_objects = {
     'ahu':[hvacDBMapping.AHUReading, hvacDBMapping.AHUReading._AHUNumber, hvacDBMapping.AHUReading._timestamp, 4,
      '2018-07-11'],
-    'vfd':[hvacDBMapping.VFDReading, hvacDBMapping.VFDReading._vfdId, hvacDBMapping.AHUReading._timestamp, 1,
+    'vfd':[hvacDBMapping.VFDReading, hvacDBMapping.VFDReading._vfdId, hvacDBMapping.VFDReading._timestamp, 1,
      '2018-07-11'],
-    'filter':[hvacDBMapping.FilterReading, hvacDBMapping.FilterReading._filterId, hvacDBMapping.AHUReading._timestamp, 1,
+    'filter':[hvacDBMapping.FilterReading, hvacDBMapping.FilterReading._filterId, hvacDBMapping.FilterReading._timestamp, 1,
      '2018-07-11'],
-    'damper':[hvacDBMapping.DamperReading, hvacDBMapping.DamperReading._damperId, hvacDBMapping.AHUReading._timestamp, 1,
+    'damper':[hvacDBMapping.DamperReading, hvacDBMapping.DamperReading._damperId, hvacDBMapping.DamperReading._timestamp, 1,
      '2018-07-11'],
     'fan':[hvacDBMapping.FanReading, hvacDBMapping.FanReading._fanId, hvacDBMapping.FanReading._timestamp, 1,
      '2018-07-11'],
@@ -34,6 +34,16 @@ read_objects = {
      hvacDBMapping.ThermafuserReading._timestamp, 1, '2018-07-11']
 }
 
+# Bytes per second per delivery stream (US West (Oregon) quota)
+FIREHOSE_MAX_BYTES_PER_SEC = 5 * 1024 * 1024
+
+# Fields of the Kinesis messages of a component type -> reading attribute, the types without an entry send to_json()
+KINESIS_MESSAGE_FIELDS = {
+    'thermafuser': {'roomOccupancy': 'roomOccupied', 'zoneTemp': 'zoneTemperature', 'supplyAir': 'supplyAir',
+                    'airFwFdbck': 'airflowFeedback', 'occCoolStpn': 'occupiedCoolingSetpoint',
+                    'occHeatStpn': 'occupiedHeatingSetpoint'},
+}
+
 # Press ⌃R to execute it or replace it with your code.
 # Press Double ⇧ to search everywhere for classes, files, tool windows, actions, and settings.
 
@@ -172,93 +182,158 @@ def test_sql():
             print(msg)
 
 
-def get_sql_records(object_type, object_key, object_timestamp, key, timestamp, limit=10):
+def stream_to_kinesis(object_type_str='thermafuser', stream_name='StockTradeStream', component_ids=None, speedup=1.0,
+                      start_time=None, end_time=None, kinesis_sink=None, meter=None):
+    """Replay once the readings of some components (all the components of the type by default) to a Kinesis stream.
 
-    #sqlsession, sqlengine = auxiliary.connect_to_db('localhost', 'hvac2018_04', 'dlaredo', '@Dexsys13')
+    The readings are sent in put_records batches through kinesis_sink (a sinks.KinesisBatchSink) with the
+    component id as partition key, so the components are spread over the shards of the stream. If kinesis_sink
+    is None a sink is created and closed when the replay ends. The messages keep the fields of
+    KINESIS_MESSAGE_FIELDS and the send time as timestamp, plus the factoryId and objectId of the reading."""
 
-    sqlsession, sqlengine = auxiliary.connect_to_db('factory1.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'hvac2018_04', 'admin', 'Dexsys131')
+    app_logger = logging.getLogger(__name__)
+    object_type, object_key, object_timestamp, key, timestamp = read_objects[object_type_str]
 
-    q = sqlsession.query(object_type).filter(and_(object_key == key, object_timestamp >= timestamp))
+    if start_time is None:
+        start_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
 
-    #q = sqlsession.query(hvacDBMapping.ThermafuserReading).filter(and_(hvacDBMapping.ThermafuserReading._timestamp < '2020-12-31'))
-    results = q.limit(limit).all()
+    sqlengine = auxiliary.get_engine('factory1.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'hvac2018_04', 'admin', 'Dexsys131')
 
-    return results
+    own_sink = kinesis_sink is None
 
+    if own_sink:
+        kinesis_sink = sinks.KinesisBatchSink(boto3.session.Session().client('kinesis', region_name='us-west-2'))
 
-def stream_to_kinesis():
-    # print(q)
+    result = None
 
-    kinesis_client = boto3.client('kinesis', region_name='us-west-2')
+    try:
+        if not component_ids:
+            component_ids = replay.component_ids(sqlengine, object_key, object_timestamp, start_time, end_time)
 
-    results = get_sql_records(1000)
+        cursor = replay.ReplayCursor(sqlengine, object_type, object_key, object_timestamp, component_ids, start_time, end_time)
+        clock = replay.ReplayClock(speedup)
+        message_fields = KINESIS_MESSAGE_FIELDS.get(object_type_str)
 
-    while True:
-        for result in results:
-            msg = {'timestamp': str(datetime.datetime.now()), 'roomOccupancy': result.roomOccupied,
-                   'zoneTemp': result.zoneTemperature,
-                   'supplyAir': result.supplyAir, 'airFwFdbck': result.airflowFeedback,
-                   'occCoolStpn': result.occupiedCoolingSetpoint,
-                   'occHeatStpn': result.occupiedHeatingSetpoint}
+        for result in cursor:
+            # The readings buffered before a gap are sent now, the sink flusher sends the ones put just before it
+            if clock.delay(result.timestamp) > 0:
+                kinesis_sink.flush_expired()
 
-            time.sleep(5)
+            clock.wait(result.timestamp)
 
-            print(msg)
-            kinesis_client.put_record(StreamName='StockTradeStream', Data=json.dumps(msg), PartitionKey='123')
+            component_id = getattr(result, object_key.key)
 
+            if message_fields is not None:
+                msg = {'timestamp': str(datetime.datetime.now())}
+                msg.update((field, getattr(result, attribute)) for field, attribute in message_fields.items())
+            else:
+                msg = result.to_json()
 
-def stream_to_firehose(object_type_str):
-    #print(q)
+            msg['factoryId'] = 1
+            msg['objectId'] = component_id
+
+            kinesis_sink.put(stream_name, json.dumps(msg), component_id)
+
+            if meter is not None:
+                meter.add()
+
+    except Exception as e:
+        app_logger.error(e)
+
+    if own_sink:
+        kinesis_sink.close()
+        app_logger.error('Kinesis sink stats for {}: {}'.format(stream_name, kinesis_sink.stats()))
+    else:
+        kinesis_sink.flush_expired()
+
+    return result.timestamp if result is not None else None
+
+
+def stream_to_firehose(object_type_str, speedup=1.0, keep_timestamps=False, start_time=None, end_time=None,
+                       firehose_sink=None, meter=None):
+    """Replay the readings of a component type to its delivery stream.
+
+    speedup scales the replay clock (None for as fast as possible). With keep_timestamps the readings keep their
+    original timestamps and the history is replayed only once, otherwise it loops from start_time forever.
+    The readings are sent in batches through firehose_sink (a sinks.FirehoseBatchSink shared by all the
+    producers), if it is None a sink is created for this component type and closed when the replay ends."""
+
+    result = None
 
     try:
         app_logger = logging.getLogger(__name__)
         object_type, object_key, object_timestamp, key, timestamp = read_objects[object_type_str]
-        start_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
+
+        if start_time is None:
+            start_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
 
         print(object_type_str)
 
-        aws_session = boto3.session.Session()
-        kinesis_client = aws_session.client('firehose', region_name='us-west-2')
+        # The engine is shared by every producer thread, the cursor reuses its connection pool for every page
+        sqlengine = auxiliary.get_engine('factory1.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'hvac2018_04', 'admin', 'Dexsys131')
+
+        own_sink = firehose_sink is None
+
+        if own_sink:
+            aws_session = boto3.session.Session()
+            firehose_sink = sinks.FirehoseBatchSink(aws_session.client('firehose', region_name='us-west-2'),
+                                                    max_bytes_per_sec=FIREHOSE_MAX_BYTES_PER_SEC)
+
         stream_name = object_type_str + '1-20210310'
         print(stream_name)
     except Exception as e:
         app_logger.error(e)
+        return None
 
     while True:
 
         try:
-            results = get_sql_records(object_type, object_key, object_timestamp, key, start_time, 1000)
+            cursor = replay.ReplayCursor(sqlengine, object_type, object_key, object_timestamp, [key], start_time, end_time)
+            clock = replay.ReplayClock(speedup)
 
-            if results:
+            for result in cursor:
+                # The readings buffered before a gap are sent now, the sink flusher sends the ones put just before it
+                if clock.delay(result.timestamp) > 0:
+                    firehose_sink.flush_expired()
 
-                for result in results:
-                    msg = result.to_json()
-                    msg['factoryId'] = 1
-                    msg['objectId'] = 1
-                    #app_logger.error(msg)
-                    print(msg)
-                    kinesis_client.put_record(DeliveryStreamName=stream_name, Record={'Data':json.dumps(msg)})
-                    time.sleep(5)
+                clock.wait(result.timestamp)
 
-                #print("se acabo")
+                msg = result.to_json()
+                msg['factoryId'] = 1
+                msg['objectId'] = 1
 
-            else:
+                if keep_timestamps:
+                    msg['timestamp'] = str(result.timestamp)
 
-                print(start_time)
-                start_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
+                # Printing every reading would cap the replay at the speed of the console
+                app_logger.debug(msg)
 
-                try:
-                    start_time = start_time + datetime.timedelta(seconds=1)
-                    app_logger.error('Getting new batch of data \n')
-                except Exception as e:
-                    app_logger.error(e)
-                    break
+                firehose_sink.put(stream_name, json.dumps(msg))
+
+                if meter is not None:
+                    meter.add()
+
+            if cursor.rows == 0:
+                app_logger.error('No data found for {} after {}'.format(object_type_str, start_time))
+                break
+
+            if keep_timestamps:
+                app_logger.error('Backfill of {} done, {} rows read\n'.format(object_type_str, cursor.rows))
+                break
+
+            app_logger.error('Getting new batch of data \n')
 
         except Exception as e:
             app_logger.error(e)
             break
 
-    return result.timestamp
+    if own_sink:
+        firehose_sink.close()
+        app_logger.error('Firehose sink stats for {}: {}'.format(stream_name, firehose_sink.stats()))
+    else:
+        firehose_sink.flush_expired()
+
+    return result.timestamp if result is not None else None
 
 
 def f(x):
@@ -274,6 +349,17 @@ def f(x):
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--speedup', type=float, default=1.0, help='Replay speed relative to the original cadence, e.g. 1000')
+    parser.add_argument('--as-fast-as-possible', action='store_true', help='Ignore the replay clock')
+    parser.add_argument('--keep-timestamps', action='store_true', help='Send the original timestamps (backfill) and stop after one pass')
+    parser.add_argument('--start-date', type=str, default=None, help='YYYY-MM-DD, defaults to the date in read_objects')
+    parser.add_argument('--end-date', type=str, default=None, help='YYYY-MM-DD, exclusive')
+    parser.add_argument('--max-bytes-per-sec', type=float, default=FIREHOSE_MAX_BYTES_PER_SEC,
+                        help='Bytes per second sent to each delivery stream')
+    parser.add_argument('--max-batches-in-flight', type=int, default=8, help='put_record_batch calls running at once')
+    args = parser.parse_args()
+
     app_logger = logging.getLogger(__name__)
     app_logger.setLevel(logging.WARNING)
     app_fh = logging.FileHandler('LogFiles/producer.log')
@@ -307,12 +393,25 @@ if __name__ == '__main__':
             print(result)
     """
 
+    replay_options = {'speedup': None if args.as_fast_as_possible else args.speedup, 'keep_timestamps': args.keep_timestamps,
+                      'start_time': datetime.datetime.strptime(args.start_date, '%Y-%m-%d') if args.start_date else None,
+                      'end_time': datetime.datetime.strptime(args.end_date, '%Y-%m-%d') if args.end_date else None,
+                      'firehose_sink': sinks.FirehoseBatchSink(boto3.session.Session().client('firehose', region_name='us-west-2'),
+                                                               max_in_flight=args.max_batches_in_flight,
+                                                               max_bytes_per_sec=args.max_bytes_per_sec),
+                      'meter': replay.ThroughputMeter('firehose', app_logger)}
+
     try:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            executor.map(stream_to_firehose, object_types)
+        with concurrent.futures.ThreadPoolExecutor(len(object_types)) as executor:
+            executor.map(lambda object_type_str: stream_to_firehose(object_type_str, **replay_options), object_types)
     except (KeyboardInterrupt, SystemExit):
         sys.exit()
 
+    replay_options['firehose_sink'].close()
+
+    app_logger.error('Replay throughput: {}'.format(replay_options['meter'].summary()))
+    app_logger.error('Firehose sink stats: {}'.format(replay_options['firehose_sink'].stats()))
+
     #output = [p.get() for p in results]
     #print(output)
 
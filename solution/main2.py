@@ -1,25 +1,22 @@
+import argparse
+import asyncio
 import logging
 import time
-import boto3
 import uuid
 import json
 import sys
 import datetime
-from multiprocessing import Pool
-import concurrent.futures
-import re
 import traceback
 
-from common import auxiliary
+from common import auxiliary, replay, sinks
 from db import hvacDBMapping
 
-from botocore.config import Config
-
-from sqlalchemy import and_
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
 
 read_objects = {
     'ahu':{'params': [hvacDBMapping.AHUReading, hvacDBMapping.AHUReading._AHUNumber, hvacDBMapping.AHUReading._timestamp, '2018-07-11'], 'objs':None},
-    'vfd':{'params': [hvacDBMapping.VFDReading, hvacDBMapping.VFDReading._vfdId, hvacDBMapping.AHUReading._timestamp, '2018-07-11'], 'objs':None},
+    'vfd':{'params': [hvacDBMapping.VFDReading, hvacDBMapping.VFDReading._vfdId, hvacDBMapping.VFDReading._timestamp, '2018-07-11'], 'objs':None},
     'filter':{'params': [hvacDBMapping.FilterReading, hvacDBMapping.FilterReading._filterId, hvacDBMapping.FilterReading._timestamp, '2018-07-11'], 'objs':None},
     'damper':{'params': [hvacDBMapping.DamperReading, hvacDBMapping.DamperReading._damperId, hvacDBMapping.DamperReading._timestamp, '2018-07-11'], 'objs':None},
     'fan':{'params': [hvacDBMapping.FanReading, hvacDBMapping.FanReading._fanId, hvacDBMapping.FanReading._timestamp, '2018-07-11'], 'objs':None},
@@ -30,13 +27,18 @@ read_objects = {
      hvacDBMapping.ThermafuserReading._timestamp, '2018-07-11'], 'objs':None}
 }
 
-def records_to_timestream_format(record, timestream_write_client, obj_type_str):
-    #print("Writing records")
+# Timestream measure types and serializers, computed once from the column types of each reading class
+for object_type_str in read_objects:
+    read_objects[object_type_str]['schema'] = sinks.timestream_schema(read_objects[object_type_str]['params'][0])
+
+def records_to_timestream_format(record, obj_type_str):
+    """Return the Timestream dimensions and the records with the measures of a reading"""
     app_logger = logging.getLogger(__name__)
 
-    d_types = {'int':'BIGINT', 'float':'DOUBLE', 'bool':'BOOLEAN'}
+    schema = read_objects[obj_type_str]['schema']
     records = []
 
+    # The dimensions are shared by all the measures of a reading, the writer sends them as CommonAttributes
     dimensions = [
         {'Name': 'Factory_Id', 'Value': record['factoryId']},
         {'Name': 'Component_Id', 'Value': record['objectId']},
@@ -44,165 +46,166 @@ def records_to_timestream_format(record, timestream_write_client, obj_type_str):
         {'Name': 'Component_Name', 'Value': record['name']},
     ]
 
-    excludedKeys = set(['factoryId', 'objectId', 'name', 'type', 'timestamp', 'timestamp_timestream'])
-    includedKeys = record.keys() - excludedKeys
-
     try:
-        for key in includedKeys:
+        for key, (measure_value_type, serializer) in schema.items():
+            value = record.get(key)
 
-            d_type = str(type(record[key]))
-            match = re.search('^\<class\s\'(.*)\'\>$', d_type)
-
-            if match:
-                d_type = match.group(1)
-                if d_type in d_types:
-                    ts_record = {'Dimensions': dimensions, 'MeasureName': key, 'MeasureValue': str(record[key]), 'MeasureValueType':d_types[d_type], 'Time': record['timestamp_timestream']}
-                    records.append(ts_record)
-            else:
-                continue
+            if value is not None:
+                records.append({'MeasureName': key, 'MeasureValue': serializer(value), 'MeasureValueType': measure_value_type,
+                                'Time': record['timestamp_timestream']})
 
     except Exception as err:
         print("Error:", err)
         print(traceback.print_exc())
         app_logger.error(traceback.print_exc())
 
-    try:
-        result = timestream_write_client.write_records(DatabaseName='octank-america-hvac', TableName=obj_type_str+'_readings',
-                                           Records=records, CommonAttributes={})
+    return dimensions, records
 
-        if result['ResponseMetadata']['HTTPStatusCode'] != 200:
-            print('Status: ' + str(result['ResponseMetadata']))
-            app_logger.error('Status: ' + str(result['ResponseMetadata']))
 
-        #print("WriteRecords Status: [%s]" % result['ResponseMetadata']['HTTPStatusCode'])
-    except Exception as err:
-        print("Error:", err)
-        print(traceback.print_exc())
-        app_logger.error(traceback.print_exc())
+async def replay_component(key, queue, clock, timestream_writer, object_type_str, objs_metadata, keep_timestamps=False,
+                           rate_limiter=None, meter=None):
+    """Send the readings of one component when the replay clock reaches their timestamp.
 
+    With keep_timestamps the readings keep their original timestamp instead of the current time (backfill)."""
 
-def get_sql_records(object_type, object_key, object_timestamp, key, timestamp, limit=10):
-
-    #sqlsession, sqlengine = auxiliary.connect_to_db('localhost', 'hvac2018_04', 'dlaredo', '@Dexsys13')
-
-    sqlsession, sqlengine = auxiliary.connect_to_db('factory2.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'hvac2018_04', 'admin', 'Dexsys131')
+    while True:
+        reading = await queue.get()
 
-    q = sqlsession.query(object_type).filter(and_(object_key == key, object_timestamp > timestamp))
+        if reading is None:
+            break
 
-    results = q.limit(limit).all()
+        await clock.wait_async(reading.timestamp)
 
-    return results
+        msg_time = reading.timestamp if keep_timestamps else datetime.datetime.now()
 
+        msg = reading.to_json()
+        msg['timestamp'] = str(msg_time)
+        msg['timestamp_timestream'] = str(int(round(msg_time.timestamp()*1000)))
+        msg['factoryId'] = 'Octank Oregon'
+        msg['objectId'] = str(key)
+        msg['name'] = objs_metadata[key][0]
+        msg['type'] = objs_metadata[key][1]
 
-def stream_to_firehose(object_type_str):
+        dimensions, records = records_to_timestream_format(msg, object_type_str)
 
-    sql_results = {}
-    db_buffer = 5
-    time_delta_secs = 5
+        if records:
+            if rate_limiter is not None:
+                await rate_limiter.acquire_async(len(records))
 
-    print('Writing data to streams: ' + object_type_str)
-    app_logger.error('Writing data to streams: ' + object_type_str)
+            await timestream_writer.add(dimensions, records)
 
-    try:
-        object_type, object_key, object_timestamp, timestamp = read_objects[object_type_str]['params']
-        object_details = read_objects[object_type_str]['objs']
+            if meter is not None:
+                meter.add(len(records))
 
-        objs_metadata = {obj.componentId:[obj.name, obj.componentType] for obj in object_details}
 
-        query_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
+async def stream_to_firehose(object_type_str, async_engine, aws_session, speedup=1.0, keep_timestamps=False, start_time=None,
+                             end_time=None, max_records_per_sec=None):
+    """Replay the readings of a component type to Timestream.
 
-        aws_session = boto3.session.Session()
-        kinesis_client = aws_session.client('firehose', region_name='us-west-2')
-        stream_name = object_type_str + '1-20210310'
-        timestream_write_client = aws_session.client('timestream-write', config=Config(read_timeout=20, max_pool_connections=5000,
-                                                                        retries={'max_attempts': 10}))
+    speedup scales the replay clock (None for as fast as possible). With keep_timestamps the readings keep their
+    original timestamps and the history is replayed only once, otherwise it loops from start_time forever.
+    max_records_per_sec caps the Timestream records written for this type."""
 
-        for key in objs_metadata.keys():
-            sql_results[key] = {}
-            sql_results[key]['data'] = get_sql_records(object_type, object_key, object_timestamp, key, query_time, db_buffer)
-            sql_results[key]['max_records'] = len(sql_results[key]['data'])
-            sql_results[key]['current_record'] = 0
-            sql_results[key]['start_time'] = query_time
+    page_size = 1000
+    queue_size = 100
 
-    except Exception as e:
-        app_logger.error(e)
-        print(traceback.print_exc())
-        app_logger.error(traceback.print_exc())
-
-    while True:
-
-        #print(sql_results)
+    print('Writing data to streams: ' + object_type_str)
+    app_logger.error('Writing data to streams: ' + object_type_str)
 
-        try:
+    object_type, object_key, object_timestamp, timestamp = read_objects[object_type_str]['params']
+    object_details = read_objects[object_type_str]['objs']
 
-            for key in sql_results.keys():
+    objs_metadata = {obj.componentId:[obj.name, obj.componentType] for obj in object_details}
 
-                if sql_results[key]['current_record'] == sql_results[key]['max_records']:
+    if start_time is None:
+        start_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
 
-                    data = []
-                    stream_results = []
+    rate_limiter = replay.RateLimiter(max_records_per_sec) if max_records_per_sec else None
+    meter = replay.ThroughputMeter(object_type_str + '_readings', app_logger)
 
-                    query_time = sql_results[key]['data'][-1].timestamp
-                    query_time = query_time + datetime.timedelta(seconds=time_delta_secs)
-                    print('Getting new batch of data for {}\n'.format(key))
-                    print(query_time)
-                    app_logger.error('Getting new batch of data for {}\n'.format(key))
-                    app_logger.error(query_time)
-                    records = get_sql_records(object_type, object_key, object_timestamp, key, query_time, db_buffer)
+    async with aws_session.create_client('timestream-write', region_name='us-west-2',
+                                         config=AioConfig(read_timeout=20, max_pool_connections=500, retries={'max_attempts': 10})) as timestream_write_client:
 
-                    if not records:
-                        app_logger.error('Resetting time for {}\n'.format(key))
-                        query_time = datetime.datetime.strptime(timestamp, '%Y-%m-%d')
-                        records = get_sql_records(object_type, object_key, object_timestamp, key, query_time, db_buffer)
+        timestream_writer = sinks.AsyncTimestreamBatchWriter(timestream_write_client, 'octank-america-hvac', object_type_str + '_readings')
+        flusher = asyncio.ensure_future(timestream_writer.run_flusher())
 
-                    data = records[:]
-                    sql_results[key]['data'] = data
-                    sql_results[key]['max_records'] = len(data)
-                    sql_results[key]['current_record'] = 0
-                    sql_results[key]['start_time'] = query_time
+        try:
+            while True:
+                # One task per component, all of them released by the same replay clock. The cursor pages through
+                # all the components of this type and hands each reading to the queue of its component
+                clock = replay.ReplayClock(speedup)
+                queues = {key: asyncio.Queue(maxsize=queue_size) for key in objs_metadata}
+                tasks = [asyncio.ensure_future(replay_component(key, queues[key], clock, timestream_writer, object_type_str, objs_metadata,
+                                                                keep_timestamps, rate_limiter, meter))
+                         for key in objs_metadata]
 
-                else:
-                    data = sql_results[key]['data']
+                cursor = replay.AsyncReplayCursor(async_engine, object_type, object_key, object_timestamp, objs_metadata.keys(), start_time,
+                                                  end_time, page_size=page_size)
 
-                    msg = data[sql_results[key]['current_record']].to_json()
-                    msg['timestamp'] = str(datetime.datetime.now())
-                    msg['timestamp_timestream'] = str(int(round(datetime.datetime.now().timestamp()*1000)))
-                    msg['factoryId'] = 'Octank Oregon'
-                    msg['objectId'] = str(key)
-                    msg['name'] = objs_metadata[key][0]
-                    msg['type'] = objs_metadata[key][1]
+                try:
+                    async for reading in cursor:
+                        await queues[getattr(reading, object_key.key)].put(reading)
 
-                    sql_results[key]['current_record'] = sql_results[key]['current_record'] + 1
+                    for queue in queues.values():
+                        await queue.put(None)
 
-                    print(msg)
-                    print('\n')
-                    print(sys.getsizeof(msg))
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
 
-                    """
-                    records_to_timestream_format(msg, timestream_write_client, object_type_str)
-                    result = kinesis_client.put_record(DeliveryStreamName=stream_name, Record={'Data':json.dumps(msg)})
+                if cursor.rows == 0:
+                    app_logger.error('No data found for {} after {}'.format(object_type_str, start_time))
+                    break
 
-                    if result['ResponseMetadata']['HTTPStatusCode'] != 200:
-                        print('Status: ' + str(result['ResponseMetadata']))
-                        app_logger.error('Status: ' + str(result['ResponseMetadata']))
-                        print(traceback.print_exc())
-                        app_logger.error(traceback.print_exc())
-                    """
+                if keep_timestamps:
+                    app_logger.error('Backfill of {} done, {} rows read in {} pages\n'.format(object_type_str, cursor.rows, cursor.pages))
+                    break
 
-            time.sleep(time_delta_secs)
+                app_logger.error('Resetting time for {}, {} rows read in {} pages\n'.format(object_type_str, cursor.rows, cursor.pages))
 
         except Exception as e:
             app_logger.error(e)
             print(traceback.print_exc())
-            app_logger.error(traceback.print_exc())
-            break
+            app_logger.error(traceback.format_exc())
+
+        finally:
+            flusher.cancel()
+            await timestream_writer.flush()
+            app_logger.error('Timestream writer stats for {}: {}'.format(object_type_str, timestream_writer.stats()))
+            app_logger.error('Replay throughput for {}: {}'.format(object_type_str, meter.summary()))
 
     return None
 
 
+async def stream_all(object_types, **replay_options):
+    """Replay every component type in a single event loop, replay_options are passed to stream_to_firehose"""
+
+    async_engine = auxiliary.get_async_engine('factory2.czy5c8ouxr1q.us-west-2.rds.amazonaws.com', 'hvac2018_04', 'admin', 'Dexsys131')
+    aws_session = get_session()
+
+    try:
+        await asyncio.gather(*(stream_to_firehose(object_type_str, async_engine, aws_session, **replay_options) for object_type_str in object_types))
+    finally:
+        app_logger.error('Connection pool stats: {}'.format(auxiliary.get_pool_metrics()))
+        await auxiliary.dispose_async_engines()
+
+
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--speedup', type=float, default=1.0, help='Replay speed relative to the original cadence, e.g. 1000')
+    parser.add_argument('--as-fast-as-possible', action='store_true', help='Ignore the replay clock')
+    parser.add_argument('--keep-timestamps', action='store_true',
+                        help='Send the original timestamps (backfill) and stop after one pass. Timestream rejects records older than '
+                             'the memory store retention unless magnetic store writes are enabled')
+    parser.add_argument('--start-date', type=str, default=None, help='YYYY-MM-DD, defaults to the date in read_objects')
+    parser.add_argument('--end-date', type=str, default=None, help='YYYY-MM-DD, exclusive')
+    parser.add_argument('--max-records-per-sec', type=float, default=None,
+                        help='Timestream records per second per component type, keep it under the ingestion quota of the account')
+    args = parser.parse_args()
+
     app_logger = logging.getLogger(__name__)
     app_logger.setLevel(logging.WARNING)
     app_fh = logging.FileHandler('LogFiles/producer.log')
@@ -282,8 +285,11 @@ if __name__ == '__main__':
     """
 
     try:
-        with concurrent.futures.ThreadPoolExecutor(len(object_types)) as executor:
-            executor.map(stream_to_firehose, object_types)
+        asyncio.run(stream_all(object_types, speedup=None if args.as_fast_as_possible else args.speedup,
+                               keep_timestamps=args.keep_timestamps,
+                               start_time=datetime.datetime.strptime(args.start_date, '%Y-%m-%d') if args.start_date else None,
+                               end_time=datetime.datetime.strptime(args.end_date, '%Y-%m-%d') if args.end_date else None,
+                               max_records_per_sec=args.max_records_per_sec))
     except (KeyboardInterrupt, SystemExit):
         sys.exit()
 